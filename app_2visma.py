@@ -5,6 +5,7 @@ import plotly.express as px
 import io
 import re
 import numpy as np
+import pyarrow as pa
 import csv
 import traceback # Para depuración detallada si es necesario
 
@@ -23,6 +24,39 @@ fuel_file = st.sidebar.file_uploader("Cargar Archivo de Combustible (Ej: combust
 
 # --- Helper functions ---
 
+# Values treated as "no number" (parsed as 0.0), and the characters removed before numeric conversion
+NUMERIC_NA_SENTINELS = frozenset(['', '-', '.', '$', 'nan', '#N/A', 'N/A', '#VALUE!', 'None'])
+DOLLAR_SPACE_RE = re.compile(r'[$ ]')
+
+# SETUP line of the fuel file: 'SETUP,<tipo>,<valor>[,<valor2>]' (case-insensitive, every field may be quoted)
+SETUP_FIELD_PATTERN = r'\s*("(?:[^"]|"")*"\s*|[^,]*)'
+SETUP_LINE_RE = re.compile(
+    r'^"?\s*SETUP\s*"?\s*,\s*"?\s*(SALDO INICIAL GASOIL|SALDO INICIAL NAFTA|MAPEO CODIGO)\s*"?\s*,'
+    + SETUP_FIELD_PATTERN + r'(?:,' + SETUP_FIELD_PATTERN + r')?',
+    re.IGNORECASE
+)
+
+# Free-text columns returned by the parsers are stored Arrow-backed (pyarrow is a direct dependency),
+# so st.dataframe can hand the buffers over as Arrow instead of converting one Python str per cell
+TEXT_DTYPE = pd.StringDtype('pyarrow')
+
+# Column layout of the parsed stock and fuel DataFrames, and the cost categories of the eco file
+STOCK_COLUMNS = ['Codigo', 'Producto', 'Categoria', 'CantidadActual', 'CostoUnitario', 'Valor Total Item', 'Ubicacion', 'STOCK_MINIMO']
+FUEL_COLUMNS = ['Fecha', 'Equipo/Int.', 'Codigo', 'Lts Ingreso', 'Lts Egreso', 'HsKm', 'Comentarios', 'Tipo de Comb.', 'Hs/Km_Numeric', 'Costo Unitario Lt', 'Costo Total Egreso', 'Es Prestamo', 'Lts / Uso']
+ECO_CATEGORY_KEYS = ['Movilizacion', 'Costos Directos', 'Costos Indirectos/Generales', 'Utilidades']
+ECO_CATEGORY_KEY_SET = frozenset(ECO_CATEGORY_KEYS) # O(1) membership checks for parsed keys
+FUEL_STOCK_TYPES = ('GASOIL', 'NAFTA') # Fuel types shown in the stock balance, in display order
+
+# Defaults used when no file is loaded (or parsing failed critically). Built once per process instead of
+# on every rerun; the tabs only read them, never modify them in place.
+EMPTY_STOCK_DF = pd.DataFrame(columns=STOCK_COLUMNS)
+EMPTY_FUEL_DF = pd.DataFrame(columns=FUEL_COLUMNS)
+EMPTY_ECO_DATA = {
+    'invierno': {key: 0.0 for key in ECO_CATEGORY_KEYS},
+    'verano': {key: 0.0 for key in ECO_CATEGORY_KEYS}
+}
+EMPTY_FUEL_INITIAL_STOCK = {'GASOIL': 0.0, 'NAFTA': 0.0}
+
 def safe_float_parse(value_str):
     """
     Intenta convertir una cadena limpia a float.
@@ -30,10 +64,13 @@ def safe_float_parse(value_str):
     o si falla la conversión después de una limpieza básica.
     Maneja formatos comunes de decimales (. o ,).
     """
-    if pd.isna(value_str) or str(value_str).strip() in ['', '-', '.', '$', 'nan', '#N/A', 'N/A', '#VALUE!', 'None']:
+    if pd.isna(value_str):
+        return 0.0
+    value_str = str(value_str).strip()
+    if value_str in NUMERIC_NA_SENTINELS:
         return 0.0
     try:
-        value_str = str(value_str).strip().replace('$', '').replace(' ', '') # Basic cleaning
+        value_str = DOLLAR_SPACE_RE.sub('', value_str) # Basic cleaning
 
         # Handle potential thousands separators and decimal comma/dot
         # If comma exists and dot exists, and comma is last, treat comma as decimal
@@ -59,28 +96,155 @@ def safe_float_parse(value_str):
         return 0.0
 
 
+def unquote_csv_field(field):
+    """
+    Limpia un campo CSV extraído con regex: quita espacios y, si está entre comillas
+    dobles, las elimina y convierte las comillas escapadas ("") en comillas simples.
+    """
+    field = field.strip()
+    if len(field) >= 2 and field.startswith('"') and field.endswith('"'):
+        field = field[1:-1].replace('""', '"').strip()
+    return field
+
+
+def dominant_value_per_group(df, group_col, value_col):
+    """
+    Devuelve, para cada grupo de `group_col`, el valor más frecuente de `value_col`.
+    En caso de empate se toma el primero en orden, igual que `.mode()[0]`.
+    """
+    counts = df.groupby([group_col, value_col], observed=True).size()
+    top_pairs = counts.groupby(level=0, observed=True).idxmax()
+    return top_pairs.map(lambda pair: pair[1])
+
+
+def min_max_downsample_positions(values, max_points):
+    """
+    Reduce una serie ordenada a ~max_points puntos conservando su silueta: divide la serie en
+    max_points/2 tramos y de cada tramo conserva el mínimo y el máximo (más el primer y último punto).
+    Returns: np.ndarray ordenado con las posiciones a conservar.
+    """
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    n_buckets = max(max_points // 2, 1)
+    buckets = (np.arange(n) * n_buckets) // n
+    by_bucket = pd.Series(values).groupby(buckets)
+    keep = np.concatenate([by_bucket.idxmin().to_numpy(), by_bucket.idxmax().to_numpy(), [0, n - 1]])
+    return np.unique(keep)
+
+
+def build_waterfall_steps(costs, keys):
+    """
+    Pasos relativos de un gráfico de cascada: las categorías de `keys` presentes en `costs` con valor no cero.
+    Returns: tuple (lista de etiquetas, np.ndarray de valores, total de las categorías presentes).
+    """
+    present_keys = [k for k in keys if k in costs]
+    values = np.fromiter((costs[k] for k in present_keys), dtype=np.float64, count=len(present_keys))
+    non_zero = np.abs(values) > 1e-9
+    labels = np.array(present_keys, dtype=object)[non_zero].tolist()
+    return labels, values[non_zero], float(values.sum())
+
+
+def build_cost_table(costs, keys, value_label):
+    """
+    Tabla de costos por categoría para mostrar con un solo st.table.
+    Returns: DataFrame indexado por 'Categoría' con la columna `value_label` ya formateada ($1,234.56).
+    """
+    return pd.DataFrame(
+        {value_label: [f"${costs[k]:,.2f}" for k in keys]},
+        index=pd.Index(list(keys), name='Categoría'),
+    )
+
+
+def build_fuel_stock_summary(totals_by_fuel_type, initial_by_fuel_type):
+    """
+    Saldo estimado por tipo de combustible (FUEL_STOCK_TYPES): inicial + ingresos - egresos.
+    Returns: dict {tipo: {'initial', 'ingress', 'egress', 'current': float, 'has_data': bool}};
+    'has_data' indica si alguno de los cuatro valores es no cero.
+    """
+    summary = {}
+    for fuel_type in FUEL_STOCK_TYPES:
+        totals = totals_by_fuel_type.get(fuel_type, {})
+        amounts = np.array([initial_by_fuel_type.get(fuel_type, 0.0), totals.get('Lts Ingreso', 0.0), totals.get('Lts Egreso', 0.0), 0.0], dtype=np.float64)
+        amounts[3] = amounts[0] + amounts[1] - amounts[2]
+        summary[fuel_type] = {
+            'initial': float(amounts[0]), 'ingress': float(amounts[1]), 'egress': float(amounts[2]), 'current': float(amounts[3]),
+            'has_data': bool(np.abs(amounts).max() > 1e-9),
+        }
+    return summary
+
+
+def safe_float_parse_series(series):
+    """
+    Versión vectorizada de `safe_float_parse` para una columna completa (pd.Series).
+    Aplica la misma limpieza ($, espacios, separador decimal . o ,) con operaciones
+    de texto de pandas y convierte con pd.to_numeric. Los valores vacíos, centinelas
+    ('-', 'N/A', '#VALUE!', etc.) o no convertibles resultan en 0.0.
+    """
+    values = series.fillna('').astype(str).str.strip()
+    values = values.str.replace(DOLLAR_SPACE_RE, '', regex=True) # Basic cleaning
+
+    # Comma is the decimal separator when it appears after the last dot (or there is no dot at all):
+    # drop dots as thousands separators and turn the comma into a dot. Otherwise commas are thousands separators.
+    comma_is_decimal = values.str.rfind(',') > values.str.rfind('.')
+    values = values.where(
+        ~comma_is_decimal,
+        values.str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+    )
+    values = values.where(comma_is_decimal, values.str.replace(',', '', regex=False))
+
+    # Sentinels ('', '-', 'nan', '#N/A', ...) and any other unparseable text become NaN, then 0.0
+    return pd.to_numeric(values, errors='coerce').fillna(0.0).astype('float64')
+
+
+def read_head_lines(raw_bytes, max_lines):
+    """
+    Decodifica solo las primeras `max_lines` líneas del contenido binario del archivo
+    (las únicas que se inspeccionan buscando cabeceras/SETUP), sin convertir el archivo
+    completo a una lista de líneas de Python.
+    Retorna una lista de cadenas (una por línea).
+    """
+    end = 0
+    for _ in range(max_lines):
+        next_newline = raw_bytes.find(b'\n', end)
+        if next_newline == -1:
+            end = len(raw_bytes) # Fewer lines than max_lines: take the whole file
+            break
+        end = next_newline + 1
+    return raw_bytes[:end].decode("utf-8", errors='replace').split('\n')
+
+
 def find_header_row(content_lines, expected_headers_list, search_range=50):
     """
     Busca una línea que contenga exactamente los nombres de columna esperados
     en las primeras `search_range` líneas.
-    Maneja BOM (Byte Order Mark) al inicio y usa csv.reader para robustez con comas embebidas.
+    Maneja BOM (Byte Order Mark) al inicio. Compara primero contra la cabecera esperada
+    unida por comas y solo usa csv.reader (robusto con comillas/comas embebidas) en las
+    líneas que contienen todos los nombres esperados.
     Retorna el índice (0-based) de la línea si se encuentra, y los nombres limpios encontrados,
     o -1 y None si no se encuentra.
     """
+    expected_header_line = ",".join(expected_headers_list) # Computed once for the cheap comparison
+
     for i, line in enumerate(content_lines[:search_range]):
-        line_strip = line.strip()
+        line_strip = line.strip().lstrip('\ufeff') # Strip whitespace and a potential BOM
         if not line_strip: continue
 
+        # Fast path: header written exactly as expected
+        if line_strip == expected_header_line:
+            return i, list(expected_headers_list)
+
+        # A header line must contain every expected name; skip other lines without tokenizing them
+        if not all(name in line_strip for name in expected_headers_list):
+            continue
+
         try:
             # Use csv reader to correctly split fields, especially if commas are embedded and fields are quoted
             # Using a basic delimiter=',' assumes the main separator is comma.
-            reader = csv.reader(io.StringIO(line_strip), delimiter=',')
-            header_fields = next(reader) # Read the first (and only) row
+            header_fields = next(csv.reader([line_strip], delimiter=','))
 
-            # Clean field names: strip whitespace, handle potential BOM
+            # Clean field names: strip whitespace
             cleaned_fields = [f.strip() for f in header_fields]
-            if cleaned_fields and cleaned_fields[0].startswith('\ufeff'):
-                cleaned_fields[0] = cleaned_fields[0][1:] # Remove BOM
 
             # Check for exact match
             if cleaned_fields == expected_headers_list:
@@ -97,9 +261,76 @@ def find_header_row(content_lines, expected_headers_list, search_range=50):
     return -1, None
 
 
+def read_csv_data_block(raw_bytes, header_row_index, column_names):
+    """
+    Lee en bloque (lector C de pandas) todas las filas de datos ubicadas debajo
+    de la cabecera encontrada en `header_row_index`, usando `column_names` como nombres.
+    Las filas cortas se rellenan con cadenas vacías y las largas se truncan a la
+    cantidad de columnas de la cabecera. Las filas vacías se ignoran.
+    Retorna un pd.DataFrame con todas las columnas como texto.
+    """
+    return pd.read_csv(
+        io.BytesIO(raw_bytes),
+        sep=',',
+        header=None,
+        skiprows=header_row_index + 1, # Skip everything up to and including the header line
+        names=column_names,
+        usecols=range(len(column_names)), # Truncates long rows and pads short ones
+        dtype=str,
+        keep_default_na=False,
+        skip_blank_lines=True,
+        encoding='utf-8',
+        encoding_errors='replace',
+    )
+
+
+def read_csv_data_block_exact(raw_bytes, header_row_index, column_names):
+    """
+    Como `read_csv_data_block`, pero sólo acepta filas con exactamente len(column_names) campos.
+    Usa el lector python de pandas, que entrega las filas largas a `on_bad_lines`; las cortas
+    quedan con NaN en los campos faltantes (un campo vacío explícito se lee como '').
+    Returns: tuple (pd.DataFrame con las filas válidas como texto, lista de filas omitidas como listas de campos).
+    """
+    rejected_rows = []
+
+    def reject_row(fields):
+        rejected_rows.append(fields)
+        return None # Drop the row
+
+    df = pd.read_csv(
+        io.BytesIO(raw_bytes),
+        sep=',',
+        header=None,
+        skiprows=header_row_index + 1, # Skip everything up to and including the header line
+        names=column_names,
+        dtype=str,
+        keep_default_na=False,
+        skip_blank_lines=True,
+        engine='python', # on_bad_lines callables need the python engine
+        on_bad_lines=reject_row,
+        encoding='utf-8',
+        encoding_errors='replace',
+    )
+    short_rows_mask = df.isna().any(axis=1).to_numpy()
+    if short_rows_mask.any():
+        rejected_rows.extend(df[short_rows_mask].apply(lambda row: row.dropna().tolist(), axis=1).tolist())
+        df = df[~short_rows_mask].reset_index(drop=True)
+    return df, rejected_rows
+
+
 # --- Parsing Functions ---
 
 def parse_stock_visma(uploaded_file):
+    """
+    Parsea el archivo de Stock subido. Delega en `parse_stock_visma_bytes`, cacheada por
+    contenido con st.cache_data para no volver a parsear el mismo archivo en cada rerun.
+    Returns: pd.DataFrame on success, None on critical error
+    """
+    return parse_stock_visma_bytes(uploaded_file.getvalue())
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def parse_stock_visma_bytes(raw_bytes):
     """
     Parsea el archivo de Stock con la estructura simple (Codigo, Producto, Categoria,
     CantidadActual, CostoUnitario, Ubicacion, STOCK_MINIMO).
@@ -108,8 +339,8 @@ def parse_stock_visma(uploaded_file):
     Returns: pd.DataFrame on success (can be empty but structured), None on critical error
     """
     try:
-        # Read file content line by line
-        content = io.StringIO(uploaded_file.getvalue().decode("utf-8", errors='replace')).readlines() # Use errors='replace' for potential decoding issues
+        # Only the first lines are decoded for the header search
+        content = read_head_lines(raw_bytes, 50) # Header must be within the first 50 lines
 
         # --- Define the EXACT expected headers for the simple stock file ---
         expected_header_full = ['Codigo', 'Producto', 'Categoria', 'CantidadActual', 'CostoUnitario', 'Ubicacion', 'STOCK_MINIMO']
@@ -136,124 +367,57 @@ def parse_stock_visma(uploaded_file):
                  use_stock_min_column = False # Confirm we are NOT using the min column
 
 
-        # --- Read all rows after the header using csv.reader for robustness ---
-        data_rows = []
-        # Determine the expected number of fields based on the detected header
-        expected_field_count = len(detected_header_names)
-
-        for i in range(header_row_index + 1, len(content)):
-             line = content[i].strip()
-             if not line: continue # Skip empty lines
+        # --- Read all rows after the header in a single vectorized pass ---
+        # Short rows are padded with empty strings and long rows truncated to the header width.
+        df_raw_data = read_csv_data_block(raw_bytes, header_row_index, detected_header_names)
 
-             try:
-                  reader = csv.reader(io.StringIO(line), delimiter=',')
-                  fields = next(reader)
-
-                  # Pad short rows with empty strings to match the number of header fields.
-                  # This is generally safer than skipping if the row just has missing trailing data.
-                  if len(fields) < expected_field_count:
-                       padded_fields = fields + [''] * (expected_field_count - len(fields))
-                       # Optionally warn: st.warning(f"Stock parse (Simple): Línea {i+1} rellenada de {len(fields)} a {expected_field_count} campos.")
-                       data_rows.append(padded_fields)
-                  else:
-                       # Take only the first expected_field_count fields from long rows
-                       data_rows.append(fields[:expected_field_count])
 
-
-             except csv.Error:
-                  # print(f"DEBUG: csv.Error reading data line {i+1}: {line[:80]}") # Optional: uncomment
-                  st.warning(f"Stock parse (Simple): Línea de datos no parseable como CSV encontrada y omitida (línea {i+1}): {line[:80]}...")
-                  pass
-             except Exception as e:
-                   # print(f"DEBUG: Stock data parse generic error line {i+1}: {e} - {line[:80]}") # Optional: uncomment
-                   st.warning(f"Stock parse (Simple): Error procesando línea {i+1}, omitiendo: {line[:80]}... Error: {e}")
-                   pass
-
-
-        # Create a pandas DataFrame using the detected headers
         # Define the list of ALL columns we want in the final output DataFrame regardless of input
-        final_cols_order_template = ['Codigo', 'Producto', 'Categoria', 'CantidadActual', 'CostoUnitario', 'Valor Total Item', 'Ubicacion', 'STOCK_MINIMO']
+        final_cols_order_template = STOCK_COLUMNS
 
-        if not data_rows:
+        if df_raw_data.empty:
              st.warning("Stock parse (Simple): Archivo procesado, cabecera encontrada, pero no hay filas de datos válidas.")
              # Return an empty DF with ALL expected final columns for structure consistency
              return pd.DataFrame(columns=final_cols_order_template)
 
 
-        # Create DF from raw data rows with detected headers
-        df_raw_data = pd.DataFrame(data_rows, columns=detected_header_names)
-
-
         # --- Data Cleaning and Type Conversion ---
-        df_cleaned = df_raw_data.copy() # Work on a copy
-
-
-        # Convert known string columns and handle potential NaNs/None, strip whitespace
-        # Use the actual column names from df_cleaned before attempting conversion
-        string_cols_present = [col for col in ['Codigo', 'Producto', 'Categoria', 'Ubicacion'] if col in df_cleaned.columns]
-        for col in string_cols_present:
-            df_cleaned[col] = df_cleaned[col].astype(str).str.strip().fillna('')
-
-        # Add missing expected string cols with empty string default if not present
-        for col in ['Codigo', 'Producto', 'Categoria', 'Ubicacion']:
-             if col not in df_cleaned.columns:
-                  df_cleaned[col] = ''
-
-
-        # Convert numeric columns using safe_float_parse.
-        # Use the actual column names from df_cleaned before attempting conversion
-        numeric_cols_present = [col for col in ['CantidadActual', 'CostoUnitario'] if col in df_cleaned.columns]
-        for col in numeric_cols_present:
-             # Apply safe_float_parse row by row for robustness
-             df_cleaned[col] = df_cleaned[col].apply(safe_float_parse)
-
-        # Handle STOCK_MINIMO specifically based on whether it was detected
-        if 'STOCK_MINIMO' in df_cleaned.columns:
-             df_cleaned['STOCK_MINIMO'] = df_cleaned['STOCK_MINIMO'].apply(safe_float_parse)
+        # The header matched exactly (with or without STOCK_MINIMO), so every base column is present;
+        # STOCK_MINIMO is the only one that may need a default. No "add missing column" passes are needed.
+        # read_csv_data_block returns text columns without NaN (keep_default_na=False), so no astype/fillna is needed.
+
+        # Filter out rows where 'Codigo' or 'Categoria' are empty/whitespace first, so that the remaining
+        # cleanup and conversions only run on valid inventory items.
+        codigo = df_raw_data['Codigo'].str.strip()
+        categoria = df_raw_data['Categoria'].str.strip()
+        valid_rows = (codigo != '') & (categoria != '')
+        df_valid = df_raw_data[valid_rows]
+
+        # Convert numeric columns using the vectorized safe_float_parse_series.
+        # All stay float64: CantidadActual feeds Valor Total Item (money), and float32 would round
+        # quantities like 123456.78 before they are multiplied and summed.
+        cantidad_actual = safe_float_parse_series(df_valid['CantidadActual'])
+        costo_unitario = safe_float_parse_series(df_valid['CostoUnitario'])
+        if use_stock_min_column:
+             stock_minimo = safe_float_parse_series(df_valid['STOCK_MINIMO'])
         else:
-             # Add STOCK_MINIMO with default 0.0 if it wasn't in the header
-             df_cleaned['STOCK_MINIMO'] = 0.0
-
-
-        # Add any other missing numeric columns with default 0.0 if not present (shouldn't be needed based on expected headers)
-        for col in ['CantidadActual', 'CostoUnitario']:
-             if col not in df_cleaned.columns:
-                  df_cleaned[col] = 0.0
-
-
-        # --- Calculate Derived Columns ---
-        # Ensure base columns are numeric before calculation
-        df_cleaned['Valor Total Item'] = df_cleaned['CantidadActual'].fillna(0.0) * df_cleaned['CostoUnitario'].fillna(0.0)
-
-
-        # --- Final DataFrame Selection and Order ---
-        # Define the list of ALL columns we want in the final output DataFrame
-        final_cols_order = ['Codigo', 'Producto', 'Categoria', 'CantidadActual', 'CostoUnitario', 'Valor Total Item', 'Ubicacion', 'STOCK_MINIMO']
-
-        # Ensure all final columns exist in df_cleaned, adding them with defaults if necessary
-        # This loop is partially redundant with the cleaning steps above but ensures all final columns are present just before filtering/ordering
-        for col in final_cols_order:
-             if col not in df_cleaned.columns:
-                  if col in ['CantidadActual', 'CostoUnitario', 'Valor Total Item', 'STOCK_MINIMO']:
-                       df_cleaned[col] = 0.0
-                  else:
-                       df_cleaned[col] = ''
-
-
-        # Filter out rows where 'Codigo' or 'Categoria' are empty/whitespace *after* cleanup
-        # This ensures only valid inventory items are kept. Check after adding default columns.
-        if 'Codigo' in df_cleaned.columns and 'Categoria' in df_cleaned.columns:
-             df_cleaned = df_cleaned[
-                 (df_cleaned['Codigo'] != '') &
-                 (df_cleaned['Categoria'] != '')
-             ].copy()
-        else: # This state should ideally not happen if checks above added missing, but safety
-             st.error("Stock parse (Simple): Columnas 'Codigo' o 'Categoria' inesperadamente faltantes después de procesamiento. No se puede filtrar items inválidos.")
+             # STOCK_MINIMO defaults to 0.0 if it wasn't in the header
+             stock_minimo = np.zeros(len(df_valid), dtype=np.float64)
 
 
-        # Select and reorder columns for the final DataFrame
-        # Use .loc to ensure order and column presence safety after filtering
-        df_final = df_cleaned.loc[:, [col for col in final_cols_order if col in df_cleaned.columns]]
+        # --- Build the final DataFrame in one step, in the final column order ---
+        # Valor Total Item: base columns have no NaN (safe_float_parse_series fills with 0.0),
+        # so multiply the raw float64 arrays directly
+        df_final = pd.DataFrame({
+            'Codigo': codigo[valid_rows].astype(TEXT_DTYPE),
+            'Producto': df_valid['Producto'].str.strip().astype(TEXT_DTYPE),
+            'Categoria': categoria[valid_rows].astype('category'), # Few distinct values: categorical codes
+            'CantidadActual': cantidad_actual,
+            'CostoUnitario': costo_unitario,
+            'Valor Total Item': np.multiply(cantidad_actual.to_numpy(), costo_unitario.to_numpy()),
+            'Ubicacion': df_valid['Ubicacion'].str.strip().astype('category'),
+            'STOCK_MINIMO': stock_minimo,
+        }, index=df_valid.index)
 
 
         return df_final # Return the DataFrame if successful
@@ -266,6 +430,16 @@ def parse_stock_visma(uploaded_file):
 
 
 def parse_eco_visma(uploaded_file):
+    """
+    Parsea el archivo de Presupuesto subido. Delega en `parse_eco_visma_bytes`, cacheada por
+    contenido con st.cache_data para no volver a parsear el mismo archivo en cada rerun.
+    Returns: dictionary on success, None on critical error
+    """
+    return parse_eco_visma_bytes(uploaded_file.getvalue())
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def parse_eco_visma_bytes(raw_bytes):
     """
     Parsea el archivo de Presupuesto con la estructura simple (Cabecera: Categoria, Invierno, Verano;
     Filas: key, valorInv, valorVer). Mapea las filas de categoría a las claves internas de la app.
@@ -273,7 +447,8 @@ def parse_eco_visma(uploaded_file):
     Returns: dictionary on success (can be empty), None on critical error
     """
     try:
-        content = io.StringIO(uploaded_file.getvalue().decode("utf-8", errors='replace')).readlines()
+        # Only the first lines are decoded for the header search
+        content = read_head_lines(raw_bytes, 50) # Header must be within the first 50 lines
 
         # --- Find the exact header row for the simple structure ---
         expected_header_simple = ['Categoria', 'Invierno', 'Verano']
@@ -281,7 +456,7 @@ def parse_eco_visma(uploaded_file):
 
         # Define the structure that should be returned even if parsing fails critically
         # This structure is also used as the default zeroed structure
-        expected_internal_keys_eco = ['Movilizacion', 'Costos Directos', 'Costos Indirectos/Generales', 'Utilidades']
+        expected_internal_keys_eco = ECO_CATEGORY_KEYS
         zeroed_eco_data_structure = {
            'invierno': {key: 0.0 for key in expected_internal_keys_eco},
            'verano': {key: 0.0 for key in expected_internal_keys_eco}
@@ -297,58 +472,37 @@ def parse_eco_visma(uploaded_file):
             return None # Return None if header isn't found
 
         processed_header_names = detected_header_names
+
         expected_field_count = len(processed_header_names)
 
-        # --- Read all data rows after the header using csv.reader ---
-        data_rows = []
-        for i in range(header_row_index + 1, len(content)):
-             line = content[i].strip()
-             if not line: continue # Skip empty lines
-
-             try:
-                  reader = csv.reader(io.StringIO(line), delimiter=',')
-                  fields = next(reader)
-
-                  # Strict check for expected number of fields for this simple structure
-                  if len(fields) != expected_field_count:
-                       st.warning(f"ECO parse (Simple): Línea de datos con número incorrecto de campos encontrada y omitida (línea {i+1}, campos: {len(fields)}, esperados: {expected_field_count}): {line[:80]}...")
-                       continue # Skip invalid data rows
-
-                  data_rows.append(fields)
-
-             except csv.Error:
-                  # print(f"DEBUG: csv.Error reading ECO data line {i+1}: {line[:80]}") # Optional: uncomment
-                  st.warning(f"ECO parse (Simple): Línea de datos no parseable como CSV encontrada y omitida (línea {i+1}): {line[:80]}...")
-                  pass
-             except Exception as e:
-                   # print(f"DEBUG: ECO data parse generic error line {i+1}: {e} - {line[:80]}") # Optional: uncomment
-                   st.warning(f"ECO parse (Simple): Error procesando línea {i+1}, omitiendo: {line[:80]}... Error: {e}")
-                   pass
-
-        # Create a pandas DataFrame from raw data rows
-        if not data_rows:
+        # --- Read all data rows after the header in a single pass ---
+        # Strict check for expected number of fields for this simple structure: other rows are skipped with a warning
+        df_raw_data, rejected_rows = read_csv_data_block_exact(raw_bytes, header_row_index, processed_header_names)
+        for fields in rejected_rows:
+             line_text = ','.join(fields)
+             st.warning(f"ECO parse (Simple): Línea de datos con número incorrecto de campos encontrada y omitida (campos: {len(fields)}, esperados: {expected_field_count}): {line_text[:80]}...")
+
+        if df_raw_data.empty:
              st.warning("ECO parse (Simple): Archivo procesado, cabecera encontrada, pero no hay filas de datos válidas con 3 campos.")
              # Return the zeroed structure even if no data rows are found
              return zeroed_eco_data_structure
 
-        df_raw_data = pd.DataFrame(data_rows, columns=processed_header_names)
-
         # --- Data Cleaning and Mapeo to Internal Structure ---
-        df_cleaned = df_raw_data.copy()
+        df_cleaned = df_raw_data # Freshly read frame, owned by this function (no copy needed)
 
         # Ensure Categoria column exists and is string, strip whitespace
         if 'Categoria' in df_cleaned.columns:
-             df_cleaned['Categoria'] = df_cleaned['Categoria'].astype(str).str.strip()
+             df_cleaned['Categoria'] = df_cleaned['Categoria'].str.strip() # Already text without NaN (read_csv_data_block)
         else:
              st.error("ECO parse (Simple): Columna 'Categoria' faltante después de leer los datos.")
              # Return the zeroed structure if critical column is missing
              return zeroed_eco_data_structure
 
-        # Ensure numeric columns exist and apply safe_float_parse
+        # Ensure numeric columns exist and apply the vectorized safe_float_parse_series
         numeric_cols_eco = ['Invierno', 'Verano']
         for col in numeric_cols_eco:
              if col in df_cleaned.columns:
-                  df_cleaned[col] = df_cleaned[col].apply(safe_float_parse)
+                  df_cleaned[col] = safe_float_parse_series(df_cleaned[col])
              else:
                   st.warning(f"ECO parse (Simple): Columna '{col}' faltante. Usando 0.0 para estos valores.")
                   df_cleaned[col] = 0.0
@@ -373,17 +527,15 @@ def parse_eco_visma(uploaded_file):
         if not df_cleaned.empty:
             # Ensure Categoria, Invierno, Verano columns exist (checked above, but belt and suspenders)
             if all(col in df_cleaned.columns for col in ['Categoria', 'Invierno', 'Verano']):
-                for index, row in df_cleaned.iterrows():
-                    category_name_in_file = row['Categoria'] # Already stripped above
-
-                    internal_category_key = category_mapping_to_internal_key.get(category_name_in_file)
+                # Sum values per category in one vectorized pass (multiple rows may match the same category)
+                totals_by_category = df_cleaned.groupby('Categoria')[['Invierno', 'Verano']].sum() # 'Categoria' already stripped above
 
-                    if internal_category_key in expected_internal_keys_eco:
-                        # Sum values if multiple rows match the same category key
-                        parsed_costs['invierno'][internal_category_key] += row['Invierno']
-                        parsed_costs['verano'][internal_category_key] += row['Verano']
-                    # Optional: Warning for unrecognized categories removed to reduce noise,
-                    # assuming only expected categories matter for the app's fixed structure.
+                for category_name_in_file, internal_category_key in category_mapping_to_internal_key.items():
+                    if category_name_in_file in totals_by_category.index and internal_category_key in expected_internal_keys_eco:
+                        parsed_costs['invierno'][internal_category_key] += float(totals_by_category.at[category_name_in_file, 'Invierno'])
+                        parsed_costs['verano'][internal_category_key] += float(totals_by_category.at[category_name_in_file, 'Verano'])
+                # Optional: Warning for unrecognized categories removed to reduce noise,
+                # assuming only expected categories matter for the app's fixed structure.
 
             else:
                  st.error("ECO parse (Simple): Columnas 'Categoria', 'Invierno' o 'Verano' faltantes después de leer y limpiar los datos.")
@@ -400,6 +552,16 @@ def parse_eco_visma(uploaded_file):
 
 
 def parse_fuel_log(uploaded_file):
+    """
+    Parsea el archivo de Combustible subido. Delega en `parse_fuel_log_bytes`, cacheada por
+    contenido con st.cache_data para no volver a parsear el mismo archivo en cada rerun.
+    Returns: tuple (pd.DataFrame, dict) on success, None on critical error
+    """
+    return parse_fuel_log_bytes(uploaded_file.getvalue())
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def parse_fuel_log_bytes(raw_bytes):
     """
     Parsea el archivo de registro de combustible con la ESTRUCTURA SIMPLE V2.
     Espera líneas SETUP al inicio y luego una cabecera de datos simple
@@ -408,12 +570,12 @@ def parse_fuel_log(uploaded_file):
     Returns: tuple (pd.DataFrame, dict) on success (DF can be empty but structured), None on critical error
     """
     # Define the structure that should be returned even if parsing fails critically
-    empty_fuel_cols_template = ['Fecha', 'Equipo/Int.', 'Codigo', 'Lts Ingreso', 'Lts Egreso', 'HsKm', 'Comentarios', 'Tipo de Comb.', 'Hs/Km_Numeric', 'Costo Unitario Lt', 'Costo Total Egreso']
+    empty_fuel_cols_template = FUEL_COLUMNS
     zeroed_initial_stock_template = {'GASOIL': 0.0, 'NAFTA': 0.0}
 
     try:
-        # Read file content line by line
-        content = io.StringIO(uploaded_file.getvalue().decode("utf-8", errors='replace')).readlines() # Use errors='replace'
+        # Only the SETUP/header area at the top is decoded line by line
+        content = read_head_lines(raw_bytes, 100) # SETUP lines and data header must be within the first 100 lines
 
         # --- Initialize storage for setup data and main data ---
         saldo_gasoil = 0.0
@@ -423,58 +585,36 @@ def parse_fuel_log(uploaded_file):
 
         # Define the EXACT expected header names for the data block in the new simple format V2
         expected_data_header_simple_v2 = ['Fecha', 'Equipo', 'CodigoCombustible', 'LtsIngreso', 'LtsEgreso', 'HsKm', 'Comentarios', 'CostoUnitarioLt']
+        # Date formats accepted in the 'Fecha' column, most common first (day first, as documented in the sidebar)
+        expected_date_formats = ['%d-%m-%Y', '%d/%m/%Y', '%Y-%m-%d']
 
 
-        # --- Scan for SETUP lines and the DATA header line ---
+        # --- Find the DATA header line, then scan the SETUP lines above it ---
         # Limit scan to first N lines to be efficient
         search_range_setup = min(len(content), 100) # Scan up to 100 lines or EOF
-        for i, line in enumerate(content[:search_range_setup]):
-             line_strip = line.strip()
-             if not line_strip: continue
-
-             try:
-                  reader = csv.reader(io.StringIO(line_strip), delimiter=',')
-                  line_fields = next(reader)
-
-                  # Handle BOM in the very first field of the very first line
-                  if i == 0 and line_fields and line_fields[0].startswith('\ufeff'):
-                       line_fields[0] = line_fields[0][1:]
-
-                  line_fields_clean = [f.strip() for f in line_fields]
+        data_header_index, _ = find_header_row(content, expected_data_header_simple_v2, search_range=search_range_setup)
 
-             except csv.Error:
-                   # print(f"DEBUG: csv.Error during SETUP scan line {i+1}: {line_strip[:80]}") # Optional: uncomment
-                   continue # Skip lines that don't parse as simple CSV during setup scan
-             except Exception as e:
-                  # print(f"DEBUG: Generic error during SETUP scan line {i+1}: {e} - {line_strip[:80]}") # Optional: uncomment
-                  continue # Skip on other unexpected errors during setup scan
+        # SETUP lines are only read above the data header (or in the whole scan range if it was not found).
+        # A single compiled regex recognizes them and extracts their values; other lines are never tokenized.
+        setup_scan_end = data_header_index if data_header_index != -1 else search_range_setup
+        for line in content[:setup_scan_end]:
+             setup_match = SETUP_LINE_RE.match(line.strip().lstrip('\ufeff'))
+             if not setup_match: continue
 
+             setup_type = setup_match.group(1).upper()
+             first_value = unquote_csv_field(setup_match.group(2))
 
-             if line_fields_clean and line_fields_clean[0].upper() == 'SETUP':
-                 if len(line_fields_clean) > 1:
-                      setup_type = line_fields_clean[1].upper()
+             if setup_type == 'SALDO INICIAL GASOIL':
+                  saldo_gasoil = safe_float_parse(first_value) # Parse saldo
 
-                      if setup_type == 'SALDO INICIAL GASOIL':
-                           if len(line_fields_clean) > 2:
-                                saldo_gasoil = safe_float_parse(line_fields_clean[2]) # Parse saldo
+             elif setup_type == 'SALDO INICIAL NAFTA':
+                  saldo_nafta = safe_float_parse(first_value) # Parse saldo
 
-                      elif setup_type == 'SALDO INICIAL NAFTA':
-                           if len(line_fields_clean) > 2:
-                                saldo_nafta = safe_float_parse(line_fields_clean[2]) # Parse saldo
-
-                      elif setup_type == 'MAPEO CODIGO':
-                           if len(line_fields_clean) > 3:
-                                code = line_fields_clean[2]
-                                fuel_type = line_fields_clean[3] # Keep original case of fuel type from file
-                                if code and fuel_type:
-                                   fuel_type_mapping[code.strip()] = fuel_type.strip() # Store stripped values
-
-
-             # Check if THIS line EXACTLY matches the expected data header list
-             # Ensure we haven't already found the header (in case it appears multiple times)
-             elif data_header_index == -1 and line_fields_clean == expected_data_header_simple_v2:
-                 data_header_index = i
-                 break # Found the data header, stop scanning setup lines
+             elif setup_type == 'MAPEO CODIGO' and setup_match.group(3) is not None:
+                  code = first_value
+                  fuel_type = unquote_csv_field(setup_match.group(3)) # Keep original case of fuel type from file
+                  if code and fuel_type:
+                       fuel_type_mapping[code] = fuel_type # Values are already stripped
 
 
         # --- Validate if DATA header was found ---
@@ -489,13 +629,14 @@ def parse_fuel_log(uploaded_file):
 
 
         # --- Read the Data block using pandas starting from the header ---
-        data_block_string = "".join(content[data_header_index:])
         df_raw = pd.DataFrame() # Initialize empty DF in case read_csv fails
 
         try:
-            # Read as CSV, using the identified header row, reading everything as string initially
-            # Use header=0 to indicate the first row of the data_block_string is the header
-            df_raw = pd.read_csv(io.StringIO(data_block_string), sep=',', header=0, dtype=str, keep_default_na=False, low_memory=False)
+            # Read as CSV straight from the uploaded bytes, skipping the SETUP lines, reading everything as string initially
+            # Use header=0 to indicate the first row after the skipped lines is the header
+            # Keep the default C engine: the pyarrow engine infers numeric types before applying dtype=str,
+            # which would turn fuel codes like '001' into '1' and break the SETUP code mapping.
+            df_raw = pd.read_csv(io.BytesIO(raw_bytes), sep=',', skiprows=data_header_index, header=0, dtype=str, keep_default_na=False, encoding='utf-8', encoding_errors='replace')
         except Exception as e:
             st.error(f"Fuel parse (Simple V2): Error leyendo el bloque de datos CSV con cabecera (desde línea {data_header_index + 1}): {e}. Revisa la consistencia de formato entre filas de datos debajo de la cabecera.")
             # st.error(traceback.format_exc()) # Uncomment for detailed debugging
@@ -504,7 +645,7 @@ def parse_fuel_log(uploaded_file):
 
 
         # --- Data Cleaning and Type Conversion ---
-        df = df_raw.copy()
+        df = df_raw # Freshly read frame, owned by this function (no copy needed)
 
         # If df_raw is empty or has no columns after reading, return empty structured DF
         if df.empty or len(df.columns) == 0:
@@ -528,7 +669,19 @@ def parse_fuel_log(uploaded_file):
 
         # Convert 'Fecha' to datetime
         if 'Fecha' in df.columns:
-             df['Fecha'] = pd.to_datetime(df['Fecha'], errors='coerce', dayfirst=True) # Assuming day first (dd-mm-yyyy, dd/mm/yyyy)
+             # Try the documented formats with an explicit format string (no per-row format inference).
+             # Each format only parses the rows still unresolved by the previous ones.
+             fecha_text = df['Fecha'].astype(str).str.strip()
+             fecha_parsed = pd.to_datetime(fecha_text, format=expected_date_formats[0], errors='coerce')
+             for date_format in expected_date_formats[1:]:
+                  pending = fecha_parsed.isna()
+                  if not pending.any(): break
+                  fecha_parsed[pending] = pd.to_datetime(fecha_text[pending], format=date_format, errors='coerce')
+             # Fallback for any other layout: generic day-first parsing, only on the remaining non-empty values
+             pending = fecha_parsed.isna() & (fecha_text != '')
+             if pending.any():
+                  fecha_parsed[pending] = pd.to_datetime(fecha_text[pending], errors='coerce', dayfirst=True, format='mixed')
+             df['Fecha'] = fecha_parsed
         else:
              st.warning("Fuel parse (Simple V2): Columna estándar 'Fecha' no encontrada. Las filas no tienen fecha.")
              df['Fecha'] = pd.NaT # Add Date column as NaT if missing
@@ -537,44 +690,55 @@ def parse_fuel_log(uploaded_file):
         standard_string_cols = ['Equipo', 'CodigoCombustible', 'HsKm', 'Comentarios']
         for col in standard_string_cols:
             if col in df.columns:
-                 df[col] = df[col].astype(str).str.strip().fillna('')
+                 # Columns are read with dtype=str, so only short (ragged) rows can leave NaN: fill, then strip once
+                 df[col] = df[col].fillna('').str.strip()
             else:
                  st.warning(f"Fuel parse (Simple V2): Columna estándar '{col}' no encontrada. Usando cadena vacía.")
                  df[col] = ''
 
 
-        # Convert numeric columns using safe_float_parse
+        # Convert numeric columns using the vectorized safe_float_parse_series
         standard_numeric_cols_to_parse = ['LtsIngreso', 'LtsEgreso', 'CostoUnitarioLt']
         for col in standard_numeric_cols_to_parse:
              if col in df.columns:
-                  df[col] = df[col].apply(safe_float_parse)
+                  df[col] = safe_float_parse_series(df[col])
              else:
                   st.warning(f"Fuel parse (Simple V2): Columna numérica estándar '{col}' no encontrada. Usando 0.0.")
                   df[col] = 0.0
 
-        # Convert 'HsKm' specifically to numeric for ratio calculations
-        # Use the potentially cleaned 'HsKm' string column as input for parsing
-        if 'HsKm' in df.columns:
-             df['Hs/Km_Numeric'] = df['HsKm'].apply(safe_float_parse)
-        else: # HsKm was not in original columns and was added as empty string, parse from that default
-             df['Hs/Km_Numeric'] = df['HsKm'].apply(safe_float_parse) # This will be 0.0
-        # Ensure it's truly numeric; errors become NaN, then fill NaNs with 0.0 for calculations
-        df['Hs/Km_Numeric'] = pd.to_numeric(df['Hs/Km_Numeric'], errors='coerce').fillna(0.0)
+        # Convert 'HsKm' specifically to numeric for ratio calculations.
+        # 'HsKm' always exists here (added as '' above if missing); safe_float_parse_series already
+        # coerces and fills with 0.0, returning float64.
+        df['Hs/Km_Numeric'] = safe_float_parse_series(df['HsKm'])
 
+        # Efficiency ratio (Lts / Uso), computed once here instead of on every render of the ratios tab.
+        # Rows without a positive usage value get 0.0; the ratios tab only shows rows with usage > 0.
+        uso_values = df['Hs/Km_Numeric'].to_numpy()
+        lts_egreso_values = df['LtsEgreso'].to_numpy()
+        lts_per_uso = np.zeros_like(lts_egreso_values)
+        np.divide(lts_egreso_values, uso_values, out=lts_per_uso, where=uso_values > 1e-9)
+        df['Lts / Uso'] = lts_per_uso
 
-        # Calculate Costo Total Egreso (ensure columns are numeric)
-        if 'LtsEgreso' in df.columns and 'CostoUnitarioLt' in df.columns:
-             df['Costo Total Egreso'] = df['LtsEgreso'].fillna(0.0) * df['CostoUnitarioLt'].fillna(0.0) # Use standard names
-        else:
-             st.warning("Fuel parse (Simple V2): Columnas 'LtsEgreso' o 'CostoUnitarioLt' faltantes. No se puede calcular 'Costo Total Egreso'.")
-             df['Costo Total Egreso'] = 0.0
+
+        # Calculate Costo Total Egreso. Both columns always exist here (added as 0.0 above if missing) and
+        # safe_float_parse_series never returns NaN, so a single multiply is enough: no fillna temporaries.
+        df['Costo Total Egreso'] = np.multiply(df['LtsEgreso'].to_numpy(), df['CostoUnitarioLt'].to_numpy())
+
+        # Usage and the Lts / Uso ratio are only filtered on and charted, never summed: store them as float32
+        # (half the memory), downcast after the cost and ratio above were computed in float64.
+        # Liters stay float64 like the money columns, since they are summed into stock and per-equipment totals.
+        for col in ['Hs/Km_Numeric', 'Lts / Uso']:
+             df[col] = df[col].astype(np.float32)
 
 
         # Map 'CodigoCombustible' to 'Tipo de Comb.' using the mapping found in SETUP
         if 'CodigoCombustible' in df.columns:
-             # Ensure 'CodigoCombustible' is string and stripped before mapping
-             df['CodigoCombustible'] = df['CodigoCombustible'].astype(str).str.strip()
-             df['Tipo de Comb.'] = df['CodigoCombustible'].map(fuel_type_mapping).fillna('Desconocido')
+             # 'CodigoCombustible' was already converted to stripped strings with the other standard string columns.
+             # Look each distinct code up once and expand back by codes, producing a categorical directly.
+             code_positions, unique_codes = pd.factorize(df['CodigoCombustible'])
+             types_per_code = [fuel_type_mapping.get(code, 'Desconocido') for code in unique_codes]
+             type_positions, type_labels = pd.factorize(pd.Index(types_per_code, dtype=object), sort=True)
+             df['Tipo de Comb.'] = pd.Categorical.from_codes(type_positions[code_positions], categories=type_labels)
         else:
              st.warning("Fuel parse (Simple V2): Columna estándar 'CodigoCombustible' no encontrada. 'Tipo de Comb.' será 'Desconocido'.")
              df['Tipo de Comb.'] = 'Desconocido'
@@ -582,29 +746,14 @@ def parse_fuel_log(uploaded_file):
 
         # --- Filter out rows where core identifiers are empty/invalid after processing ---
         # Now that cleaning and type conversions are done, filter invalid rows.
+        # 'Fecha', 'Equipo' and 'CodigoCombustible' always exist at this point (missing ones were added with defaults above),
+        # and 'Equipo'/'CodigoCombustible' are already stripped strings, so a single combined mask is enough.
         initial_rows = len(df)
-        df_filtered = df.copy()
-
-        # Apply filters only if the columns exist
-        if 'Fecha' in df_filtered.columns:
-             df_filtered = df_filtered[df_filtered['Fecha'].notna()].copy() # Keep rows with valid date
-        else: # If Fecha column was never added, add it as NaT for consistent filtering logic below
-             df_filtered['Fecha'] = pd.NaT
-             df_filtered = df_filtered[df_filtered['Fecha'].notna()].copy() # This will remove all rows
-
-
-        if 'Equipo' in df_filtered.columns:
-             df_filtered = df_filtered[df_filtered['Equipo'].astype(str).str.strip() != ''].copy() # Keep rows with non-empty Equipo
-        else: # If Equipo column was never added, add it as empty string for consistent filtering
-             df_filtered['Equipo'] = ''
-             df_filtered = df_filtered[df_filtered['Equipo'].astype(str).str.strip() != ''].copy() # This will remove all rows
-
-
-        if 'CodigoCombustible' in df_filtered.columns:
-             df_filtered = df_filtered[df_filtered['CodigoCombustible'].astype(str).str.strip() != ''].copy() # Keep rows with non-empty CodigoCombustible
-        else: # If CodigoCombustible was never added, add it as empty string
-             df_filtered['CodigoCombustible'] = ''
-             df_filtered = df_filtered[df_filtered['CodigoCombustible'].astype(str).str.strip() != ''].copy() # This will remove all rows
+        valid_rows_mask = df['Fecha'].notna() & (df['Equipo'] != '') & (df['CodigoCombustible'] != '')
+        # Keep rows with valid date, non-empty Equipo and non-empty CodigoCombustible.
+        # take() already returns a new frame with its own data (and, unlike df[mask], is not flagged as a
+        # slice on pandas 2.x), so no extra .copy() is needed before the column assignments below.
+        df_filtered = df.take(np.flatnonzero(valid_rows_mask.to_numpy()))
 
 
         if len(df_filtered) < initial_rows:
@@ -613,6 +762,12 @@ def parse_fuel_log(uploaded_file):
         df = df_filtered # Use the filtered DataFrame going forward
 
 
+        # Flag loan rows (PRESTAMO in comments) once here so the ratios tab filters on a boolean column
+        # instead of re-scanning the comment strings for every mask. Literal, case-insensitive match.
+        if 'Comentarios' in df.columns:
+             df['Es Prestamo'] = df['Comentarios'].str.contains('PRESTAMO', case=False, regex=False, na=False)
+
+
         # --- RENAME columns to match internal application standard names ---
         # Use the standard names (from expected_data_header_simple_v2) that are now DF columns.
         rename_map_to_internal = {
@@ -629,27 +784,40 @@ def parse_fuel_log(uploaded_file):
         if cols_to_rename_actual:
              df.rename(columns=cols_to_rename_actual, inplace=True)
 
+        # Low-cardinality identifier columns used for groupby/filters/plot colors: store them as categoricals
+        # (integer codes + a few unique labels instead of one Python string per row).
+        for col in ['Equipo/Int.', 'Codigo', 'Tipo de Comb.']:
+             if col in df.columns:
+                  df[col] = df[col].astype('category')
+        # Free-text columns go to the Arrow-backed string dtype (see TEXT_DTYPE)
+        for col in ['HsKm', 'Comentarios']:
+             if col in df.columns:
+                  df[col] = df[col].astype(TEXT_DTYPE)
+
 
         # --- Ensure ALL required internal standard columns exist and are in a defined order ---
         # Define the final desired order of columns.
         internal_standard_cols_ordered = [
             'Fecha', 'Equipo/Int.', 'Codigo', 'Lts Ingreso', 'Lts Egreso', 'HsKm',
-            'Hs/Km_Numeric', 'Tipo de Comb.', 'Comentarios', 'Costo Unitario Lt', 'Costo Total Egreso'
+            'Hs/Km_Numeric', 'Tipo de Comb.', 'Comentarios', 'Costo Unitario Lt', 'Costo Total Egreso', 'Es Prestamo',
+            'Lts / Uso'
         ]
 
         # Add any missing standard columns with default values to ensure structure
         for col in internal_standard_cols_ordered:
             if col not in df.columns:
-                 if col in ['Lts Ingreso', 'Lts Egreso', 'Hs/Km_Numeric', 'Costo Unitario Lt', 'Costo Total Egreso']:
+                 if col in ['Lts Ingreso', 'Lts Egreso', 'Hs/Km_Numeric', 'Costo Unitario Lt', 'Costo Total Egreso', 'Lts / Uso']:
                      df[col] = 0.0 # Numeric defaults
                  elif col == 'Fecha':
                      df[col] = pd.NaT # Datetime default
+                 elif col == 'Es Prestamo':
+                     df[col] = False # Boolean default
                  else: # 'Equipo/Int.', 'Codigo', 'HsKm', 'Tipo de Comb.', 'Comentarios' defaults
                     df[col] = ''
 
-        # Reorder the DataFrame to the standard internal order, only keeping columns that actually exist.
-        # This ensures the returned DF has the expected columns even if empty.
-        final_df_ordered = df.loc[:, [col for col in internal_standard_cols_ordered if col in df.columns]]
+        # Reorder the DataFrame to the standard internal order. Every column exists by construction (the loop
+        # above added the missing ones), so the order list is used directly without re-checking each name.
+        final_df_ordered = df[internal_standard_cols_ordered]
 
         # Ensure the initial stock dictionary is returned, using the values found in SETUP
         initial_stock_result = {'GASOIL': saldo_gasoil, 'NAFTA': saldo_nafta}
@@ -664,13 +832,208 @@ def parse_fuel_log(uploaded_file):
         return None # Return None on critical parse failure
 
 
+# --- Derived Data Functions (tabs) ---
+# Called through get_session_derived, which keeps each result in session state per source file,
+# so widget interactions (reruns) reuse the aggregates instead of re-filtering and re-grouping
+# the whole fuel log or eco data.
+
+# Maximum points per equipment line sent to the efficiency trend chart
+TREND_MAX_POINTS_PER_EQUIPMENT = 1000
+
+
+def get_session_derived(name, source_file_id, compute, *args):
+    """
+    Devuelve un resultado derivado guardado en st.session_state para el archivo `source_file_id`
+    (o cualquier clave comparable, p. ej. una tupla (archivo, selección)).
+    Sólo llama a compute(*args) cuando la clave cambió; en los demás reruns es una búsqueda en un dict,
+    sin el hash de argumentos que hace st.cache_data en cada llamada. Es el único caché de las
+    funciones compute_*: cada resultado se guarda una sola vez, en la sesión.
+    """
+    derived_store = st.session_state.setdefault('derived_data', {})
+    entry = derived_store.get(name)
+    if entry is None or entry[0] != source_file_id:
+        entry = (source_file_id, compute(*args))
+        derived_store[name] = entry
+    return entry[1]
+
+
+def remember_trend_selection():
+    """
+    Callback del multiselect de tendencia: copia la selección a una entrada de st.session_state que no es
+    de un widget. Streamlit descarta el estado de los widgets que no se dibujan en un rerun, y con las
+    pestañas perezosas el multiselect no se dibuja mientras otra pestaña está abierta.
+    """
+    st.session_state.trend_equipos_selected = st.session_state.trend_equipos_widget
+
+def aggregate_per_equipment(rows_df, value_col, total_col):
+    """
+    Suma `value_col` por equipo y agrega el tipo de combustible más frecuente de cada equipo.
+    Returns: DataFrame con columnas 'Equipo/Int.', `total_col`, 'Tipo' (vacío si no hay filas).
+    """
+    if rows_df.empty:
+        return pd.DataFrame(columns=['Equipo/Int.', total_col, 'Tipo'])
+
+    per_equipment = rows_df.groupby('Equipo/Int.', observed=True).agg(**{total_col: (value_col, 'sum')})
+    # Most frequent fuel type per equipment from one count table instead of a per-group mode()
+    per_equipment['Tipo'] = dominant_value_per_group(rows_df, 'Equipo/Int.', 'Tipo de Comb.')
+    return per_equipment.reset_index()
+
+
+def compute_fuel_per_equipment(fuel_df):
+    """
+    Agrupa por equipo los egresos de combustible (Lts Egreso > 0) y su costo (Costo Total Egreso > 0),
+    excluyendo préstamos.
+    Returns: tuple (consumo por equipo con 'Total_Liters', costo por equipo con 'Total_Cost').
+    """
+    # Both filters share the PRESTAMO exclusion; build the masks on the raw arrays and select by position
+    not_prestamo = ~fuel_df['Es Prestamo'].to_numpy(dtype=bool)
+    consumption_positions = np.flatnonzero(not_prestamo & (fuel_df['Lts Egreso'].to_numpy() > 1e-9))
+    cost_positions = np.flatnonzero(not_prestamo & (fuel_df['Costo Total Egreso'].to_numpy() > 1e-9))
+
+    consumption_per_equipment = aggregate_per_equipment(fuel_df.take(consumption_positions), 'Lts Egreso', 'Total_Liters')
+    cost_per_equipment = aggregate_per_equipment(fuel_df.take(cost_positions), 'Costo Total Egreso', 'Total_Cost')
+    return consumption_per_equipment, cost_per_equipment
+
+
+def compute_fuel_type_totals(fuel_df):
+    """
+    Suma los litros ingresados y egresados por tipo de combustible, en una sola pasada de groupby.
+    Returns: dict {tipo: {'Lts Ingreso': float, 'Lts Egreso': float}} sólo con los tipos que tienen filas.
+    """
+    return fuel_df.groupby('Tipo de Comb.', observed=True, sort=False)[['Lts Ingreso', 'Lts Egreso']].sum().to_dict('index')
+
+
+def compute_fuel_usage_records(fuel_df):
+    """
+    Filtra los egresos con uso (Hs/Km) positivo, es decir, las filas con ratio 'Lts / Uso' válido.
+    Returns: DataFrame con las filas de fuel_df que tienen ratio válido ('Lts / Uso' viene del parser),
+    ordenado por Fecha.
+    """
+    usage_recorded_mask = (fuel_df['Lts Egreso'] > 1e-9) & (fuel_df['Hs/Km_Numeric'] > 1e-9)
+    # Sorted by date once here, so the trend filter below keeps date order without sorting again
+    return fuel_df[usage_recorded_mask].sort_values(by='Fecha', kind='stable')
+
+
+def compute_equipos_for_trend(usage_recorded_df):
+    """
+    Equipos con 2 o más registros de ratio válido (resultado de compute_fuel_usage_records),
+    de mayor a menor cantidad de registros (los empates quedan en orden de aparición).
+    """
+    # Integer codes once, then one bincount pass instead of a hash-based groupby on the labels
+    equipment_codes, equipment_labels = pd.factorize(usage_recorded_df['Equipo/Int.'])
+    counts = np.bincount(equipment_codes, minlength=len(equipment_labels))
+    with_trend = np.flatnonzero(counts >= 2)
+    ordered = with_trend[np.argsort(-counts[with_trend], kind='stable')]
+    return [equipment_labels[i] for i in ordered]
+
+
+def compute_usage_positions_by_equipment(usage_recorded_df):
+    """
+    Posiciones (en el resultado de compute_fuel_usage_records) de los registros de cada equipo.
+    Returns: dict {equipo: np.ndarray de posiciones}.
+    """
+    return usage_recorded_df.groupby('Equipo/Int.', observed=True, sort=False).indices
+
+
+def compute_trend_records(usage_recorded_df, positions_by_equipment, selected_equipos):
+    """
+    Registros con ratio válido de los equipos seleccionados, en orden de Fecha, para el gráfico de tendencia.
+    Recibe el resultado de compute_fuel_usage_records y sus posiciones por equipo.
+    Los equipos con más de TREND_MAX_POINTS_PER_EQUIPMENT registros se reducen con min/max por tramos.
+    """
+    lts_per_uso = usage_recorded_df['Lts / Uso'].to_numpy()
+    # One dict lookup per selected equipment instead of an isin() scan over every record.
+    # Long series are downsampled per equipment (each is its own line) to keep the chart payload bounded.
+    selected_positions = [
+        positions_by_equipment[equipo][min_max_downsample_positions(lts_per_uso[positions_by_equipment[equipo]], TREND_MAX_POINTS_PER_EQUIPMENT)]
+        for equipo in selected_equipos if equipo in positions_by_equipment
+    ]
+    if not selected_positions:
+        return usage_recorded_df.iloc[:0]
+    # Positions are sorted so the rows keep the date order of usage_recorded_df
+    return usage_recorded_df.take(np.sort(np.concatenate(selected_positions)))
+
+
+def build_display_table(df, columns, sort_by=None, ascending=True):
+    """
+    Proyecta (y opcionalmente ordena) `df` para mostrarlo con st.dataframe.
+    Returns: pyarrow.Table, de modo que los reruns no repiten la conversión pandas -> Arrow.
+    """
+    display_df = df[list(columns)]
+    if sort_by is not None:
+        display_df = display_df.sort_values(by=sort_by, ascending=ascending)
+    return pa.Table.from_pandas(display_df, preserve_index=False)
+
+
+def compute_inventory_table(stock_df, columns):
+    """
+    Tabla de inventario: sólo los ítems con Cantidad o Valor no cero, ordenados por 'Valor Total Item' descendente.
+    Returns: pyarrow.Table con `columns` (sin filas si ningún ítem tiene cantidad o valor).
+    """
+    # Mask built on the raw arrays; take() returns the rows without an extra defensive copy (display only)
+    cantidad_values = stock_df['CantidadActual'].to_numpy()
+    valor_values = stock_df['Valor Total Item'].to_numpy()
+    inventory_df = stock_df.take(np.flatnonzero((np.abs(cantidad_values) > 1e-9) | (np.abs(valor_values) > 1e-9)))
+    return build_display_table(inventory_df, columns, sort_by='Valor Total Item', ascending=False)
+
+
+def compute_stock_value_by_category(stock_df):
+    """
+    Suma 'Valor Total Item' por categoría de stock.
+    Returns: DataFrame con columnas 'Categoria_Group' y 'Valor Total Item'.
+    """
+    # The parser already strips 'Categoria', drops rows without it and stores it as a categorical,
+    # so the groupby runs on the category codes directly (no string copy, no re-hashing)
+    return (stock_df.groupby('Categoria', observed=True)['Valor Total Item'].sum()
+            .rename_axis('Categoria_Group').reset_index())
+
+
+def compute_stock_preview(stock_df):
+    """
+    Vista previa del catálogo de stock para la pestaña de presupuestos.
+    Returns: tuple (columnas mostradas presentes en stock_df, si 'CostoUnitario' tiene algún valor no cero,
+    DataFrame con las primeras 10 filas de esas columnas).
+    """
+    # Check if the stock file included CostoUnitario (which is key for material costs in a budget);
+    # at least one non-zero, non-null value (NaN compares False)
+    has_costo_unitario = 'CostoUnitario' in stock_df.columns and bool(np.any(np.abs(stock_df['CostoUnitario'].to_numpy(dtype=np.float64)) > 0.0))
+    # Base columns, plus CostoUnitario/Ubicacion, filtered by actual presence
+    preview_columns = [col for col in ('Codigo', 'Producto', 'Categoria', 'CantidadActual', 'CostoUnitario', 'Ubicacion') if col in stock_df.columns]
+    # Rows sliced before projecting, so only 10 rows are copied
+    return preview_columns, has_costo_unitario, stock_df.head(10)[preview_columns]
+
+
+def compute_eco_waterfall_summary(costs_inv, costs_verano, keys):
+    """
+    Resumen de costos por temporada para los gráficos de cascada.
+    Returns: dict con los pasos no cero de Invierno ('step_labels_inv', 'step_values_inv', 'step_texts_inv'),
+    los totales ('total_inv', 'total_verano') y los cambios no cero Verano - Invierno
+    ('change_labels', 'change_values', 'change_texts'). Los textos ya vienen formateados para las barras.
+    """
+    step_labels_inv, step_values_inv, total_inv = build_waterfall_steps(costs_inv, keys)
+    total_verano = build_waterfall_steps(costs_verano, keys)[2]
+    # Per-category change only for categories present in *both* dictionaries
+    category_changes = {k: costs_verano[k] - costs_inv[k] for k in keys if k in costs_inv and k in costs_verano}
+    change_labels, change_values, _ = build_waterfall_steps(category_changes, keys)
+    # Bar texts formatted here, once per eco file, instead of on every render; changes carry an explicit '+'
+    step_texts_inv = [f"${value:,.0f}" for value in step_values_inv]
+    change_texts = [f"{'+' if difference > 0 else ''}${difference:,.0f}" for difference in change_values]
+    return {
+        'step_labels_inv': step_labels_inv, 'step_values_inv': step_values_inv, 'step_texts_inv': step_texts_inv,
+        'total_inv': total_inv, 'total_verano': total_verano,
+        'change_labels': change_labels, 'change_values': change_values, 'change_texts': change_texts,
+    }
+
+
 # --- Initialize Session State ---
 # Use clear variable names
 # Initialize with None; parsing will set to DataFrame/dict or keep None on critical failure
 if 'stock_df' not in st.session_state: st.session_state.stock_df = None
+if 'stock_total_value' not in st.session_state: st.session_state.stock_total_value = None # Sum of 'Valor Total Item', set on parse
 if 'eco_data' not in st.session_state: st.session_state.eco_data = None # Will be a dictionary
 if 'fuel_df' not in st.session_state: st.session_state.fuel_df = None
 if 'fuel_initial_stock' not in st.session_state: st.session_state.fuel_initial_stock = None # Will be a dictionary
+if 'trend_equipos_selected' not in st.session_state: st.session_state.trend_equipos_selected = None # Trend multiselect choice, None until the user changes it
 
 # Add unique file identifiers to session state to track if a *new* file has been uploaded
 if 'last_stock_file_id' not in st.session_state: st.session_state.last_stock_file_id = None
@@ -682,7 +1045,8 @@ def get_file_id(file):
      if file is None: return None
      try:
          # Using only name and size as hash can be problematic with Streamlit's file handling
-         return f"{file.name}-{file.size}"
+         # A plain tuple compares by value against the stored id without building a string every rerun
+         return (file.name, file.size)
      except Exception:
          return None # Return None if file object is unexpectedly structured
 
@@ -700,12 +1064,15 @@ current_fuel_file_id = get_file_id(current_fuel_file)
 # Parse Stock File if a NEW file is uploaded (ID changed)
 if current_stock_file_id != st.session_state.last_stock_file_id:
     st.session_state.stock_df = None # Clear old data *before* trying to parse new
+    st.session_state.stock_total_value = None
     st.session_state.last_stock_file_id = current_stock_file_id # Update stored ID
 
     if current_stock_file is not None:
         # parse_stock_visma returns DF (structured empty or populated) or None on critical error
         st.session_state.stock_df = parse_stock_visma(current_stock_file)
         if st.session_state.stock_df is not None: # Check if parsing was NOT a critical error
+            # Inventory grand total only changes with the file: reduce the column once here, not on every rerun
+            st.session_state.stock_total_value = float(st.session_state.stock_df['Valor Total Item'].sum())
             if not st.session_state.stock_df.empty:
                  st.sidebar.success(f"Archivo de Stock cargado y procesado ({len(st.session_state.stock_df)} items válidos).")
             else:
@@ -723,7 +1090,7 @@ if current_eco_file_id != st.session_state.last_eco_file_id:
         st.session_state.eco_data = parse_eco_visma(current_eco_file)
         if st.session_state.eco_data is not None: # Check if parsing was NOT a critical error
              # Check if any non-zero values were parsed (now checking the actual parsed data, which might be the zeroed structure)
-             expected_keys_eco = ['Movilizacion', 'Costos Directos', 'Costos Indirectos/Generales', 'Utilidades'] # These must match keys in eco_data structure
+             expected_keys_eco = ECO_CATEGORY_KEYS # These must match keys in eco_data structure
              has_eco_values = (
                  any(abs(st.session_state.eco_data.get('invierno',{}).get(k, 0.0)) > 1e-9 for k in expected_keys_eco) or
                  any(abs(st.session_state.eco_data.get('verano',{}).get(k, 0.0)) > 1e-9 for k in expected_keys_eco)
@@ -741,6 +1108,7 @@ if current_eco_file_id != st.session_state.last_eco_file_id:
 if current_fuel_file_id != st.session_state.last_fuel_file_id:
     st.session_state.fuel_df = None # Clear old data
     st.session_state.fuel_initial_stock = None # Clear old data
+    st.session_state.trend_equipos_selected = None # A new file has its own equipment: back to the default selection
     st.session_state.last_fuel_file_id = current_fuel_file_id # Update stored ID
 
     if current_fuel_file is not None:
@@ -773,28 +1141,34 @@ if current_fuel_file_id != st.session_state.last_fuel_file_id:
 # Explicitly check for None after retrieval and provide default structures
 stock_df = st.session_state.get('stock_df')
 if stock_df is None:
-    # Define the full expected columns for an empty stock DF if parsing failed critically
-    empty_stock_cols = ['Codigo', 'Producto', 'Categoria', 'CantidadActual', 'CostoUnitario', 'Valor Total Item', 'Ubicacion', 'STOCK_MINIMO']
-    stock_df = pd.DataFrame(columns=empty_stock_cols) # Set a default empty structured DF
+    stock_df = EMPTY_STOCK_DF # Default empty structured DF (module-level, shared across reruns)
 
 eco_data = st.session_state.get('eco_data') # Retrieve value from state
 if eco_data is None:
-    # Define the full expected structure for empty eco_data if parsing failed critically
-    expected_keys_eco = ['Movilizacion', 'Costos Directos', 'Costos Indirectos/Generales', 'Utilidades']
-    eco_data = {
-       'invierno': {key: 0.0 for key in expected_keys_eco},
-       'verano': {key: 0.0 for key in expected_keys_eco}
-    } # Set a default empty structured dict
+    eco_data = EMPTY_ECO_DATA # Default zeroed structure
 
 fuel_df = st.session_state.get('fuel_df') # Retrieve value from state
 if fuel_df is None:
-     # Define the full expected columns for an empty fuel DF if parsing failed critically
-     empty_fuel_cols = ['Fecha', 'Equipo/Int.', 'Codigo', 'Lts Ingreso', 'Lts Egreso', 'HsKm', 'Comentarios', 'Tipo de Comb.', 'Hs/Km_Numeric', 'Costo Unitario Lt', 'Costo Total Egreso']
-     fuel_df = pd.DataFrame(columns=empty_fuel_cols) # Set a default empty structured DF
+     fuel_df = EMPTY_FUEL_DF # Default empty structured DF
 
 fuel_initial_stock = st.session_state.get('fuel_initial_stock') # Retrieve value from state
 if fuel_initial_stock is None:
-    fuel_initial_stock = {'GASOIL': 0.0, 'NAFTA': 0.0} # Set a default zeroed dict
+    fuel_initial_stock = EMPTY_FUEL_INITIAL_STOCK # Default zeroed dict
+
+# Which seasons the parsed eco data carries; the tabs branch on these flags instead of re-inspecting eco_data
+eco_has_seasons = eco_data.get('invierno') is not None or eco_data.get('verano') is not None
+eco_has_both_seasons = eco_data.get('invierno') is not None and eco_data.get('verano') is not None
+
+# Ordered eco categories present in each season (and any extra parsed categories),
+# computed once per rerun and shared by the tabs
+eco_costs_inv = eco_data.get('invierno') or {}
+eco_costs_verano = eco_data.get('verano') or {}
+eco_present_keys_inv = tuple(k for k in ECO_CATEGORY_KEYS if k in eco_costs_inv)
+eco_present_keys_verano = tuple(k for k in ECO_CATEGORY_KEYS if k in eco_costs_verano)
+eco_extra_keys_inv = tuple(k for k in eco_costs_inv if k not in ECO_CATEGORY_KEY_SET)
+eco_extra_keys_verano = tuple(k for k in eco_costs_verano if k not in ECO_CATEGORY_KEY_SET)
+# Main category costs of both seasons (missing keys as 0.0) for a single zero check
+eco_main_values = np.array([[costs.get(k, 0.0) for k in ECO_CATEGORY_KEYS] for costs in (eco_costs_inv, eco_costs_verano)], dtype=np.float64)
 
 # Now the variables stock_df, eco_data, fuel_df, fuel_initial_stock are guaranteed not to be None
 # They will be either the parsed data (potentially empty but structured) or the default empty structures
@@ -802,828 +1176,746 @@ if fuel_initial_stock is None:
 
 # --- Display Results in Tabs ---
 # Use the session state variables directly which are now guaranteed to be DataFrame/dict (possibly empty but structured) or None only on critical parse failure
+# on_change="rerun" makes the tabs stateful: each tab's .open tells whether it is the selected one, so only
+# that tab's filters, aggregations and figures are built on a rerun (the others are skipped entirely)
 tab_costs, tab_ratios, tab_waterfall, tab_stock, tab_budget = st.tabs([
     "Costos Operativos",
     "Ratios Consumo / Eficiencia",
     "Gráfico de Cascada",
     "Gestión de Stock",
     "Creación de Presupuestos"
-])
+], key='main_tabs', on_change='rerun')
 
 
 # --- TAB: Costos Operativos ---
 with tab_costs:
-    st.header("Análisis de Costos Operativos")
-
-    # Get cost data, using .get({}, {}) for safety if eco_data is missing 'invierno'/'verano' keys (less likely with default structure)
-    costs_inv = eco_data.get('invierno', {})
-    costs_verano = eco_data.get('verano', {})
-
-    # Define the order of categories for display and calculation totals
-    ordered_categories_internal_keys = ['Movilizacion', 'Costos Directos', 'Costos Indirectos/Generales', 'Utilidades']
-    # Check if any relevant non-zero data exists in the costs structures
-    # Check if costs_inv/verano are dicts before checking keys
-    has_inv_data_to_display = isinstance(costs_inv, dict) and any(abs(costs_inv.get(k, 0.0)) > 1e-9 for k in ordered_categories_internal_keys)
-    has_verano_data_to_display = isinstance(costs_verano, dict) and any(abs(costs_verano.get(k, 0.0)) > 1e-9 for k in ordered_categories_internal_keys)
-
-
-    if has_inv_data_to_display or has_verano_data_to_display:
-        st.subheader("Costos por Categoría (Basado en Archivo de Presupuesto Simple)")
-        st.info("La clasificación en Movilización, Directos, Indirectos, Utilidades se basa directamente en las filas leídas del archivo de presupuesto simple cargado.")
-
-        col1, col2 = st.columns(2)
-
-        if has_inv_data_to_display:
-            with col1:
-                 st.subheader("Temporada Invierno")
-                 total_inv = 0.0 # Initialize total
-                 # Iterate over ordered keys, ensuring they exist in costs_inv dict
-                 for key in [k for k in ordered_categories_internal_keys if k in costs_inv]:
-                      value = costs_inv.get(key, 0.0)
-                      st.write(f"- {key}: ${value:,.2f}") # Use key from the ordered list
-                      total_inv += value # Sum value for the total
-                 st.subheader(f"Total Calculado Invierno: ${total_inv:,.2f}")
-
-        if has_verano_data_to_display:
-            # Display verano costs in col2 if invierno data is present, otherwise in col1
-            with col2 if has_inv_data_to_display else col1:
-                st.subheader("Temporada Verano")
-                total_verano = 0.0 # Initialize total
-                # Iterate over ordered keys, ensuring they exist in costs_verano dict
-                for key in [k for k in ordered_categories_internal_keys if k in costs_verano]:
-                    value = costs_verano.get(key, 0.0)
-                    st.write(f"- {key}: ${value:,.2f}") # Use key from the ordered list
-                    total_verano += value # Sum value for the total
-                st.subheader(f"Total Calculado Verano: ${total_verano:,.2f}")
-
-        # Specific message if file was processed but no non-zero relevant data found
-        # Check if eco_data is a dictionary and it was likely populated (even with zeros)
-        elif isinstance(eco_data, dict) and (eco_data.get('invierno') is not None or eco_data.get('verano') is not None): # Check if keys exist even if values are zeroed
-             st.info("El archivo de presupuesto simple fue procesado, pero no contiene datos de costos no cero para las categorías esperadas.")
-
-    else:
-        # Message when no file was uploaded or parsing failed critically
-        st.info("Por favor, carga el archivo de `presupuesto_simple.csv` para ver el análisis de costos.")
-
-    st.markdown("---")
-    st.subheader("Sobre la Definición de Costos Operativos")
-    st.info("El análisis de costos directos variables operativos, fijos directos/indirectos, etc. depende de cómo se clasifiquen y calculen estos costos en el archivo de entrada. El archivo simple clasifica por tipo principal (Directos, Indirectos, etc.), pero la determinación de su variabilidad, o fijeza debe hacerse al generar esos totales en el archivo origen (ej. Excel).")
+    if tab_costs.open:
+        st.header("Análisis de Costos Operativos")
+
+        # Get cost data, using .get({}, {}) for safety if eco_data is missing 'invierno'/'verano' keys (less likely with default structure)
+        costs_inv = eco_data.get('invierno', {})
+        costs_verano = eco_data.get('verano', {})
+
+        # Define the order of categories for display and calculation totals
+        ordered_categories_internal_keys = ECO_CATEGORY_KEYS
+        # Check if any relevant non-zero data exists in the costs structures
+        # Check if costs_inv/verano are dicts before checking keys
+        # Values per category (0.0 if absent) are looked up once and reused for the non-zero check and the totals
+        values_inv = [costs_inv.get(k, 0.0) for k in ordered_categories_internal_keys] if isinstance(costs_inv, dict) else []
+        values_verano = [costs_verano.get(k, 0.0) for k in ordered_categories_internal_keys] if isinstance(costs_verano, dict) else []
+        has_inv_data_to_display = any(abs(value) > 1e-9 for value in values_inv)
+        has_verano_data_to_display = any(abs(value) > 1e-9 for value in values_verano)
+
+
+        if has_inv_data_to_display or has_verano_data_to_display:
+            st.subheader("Costos por Categoría (Basado en Archivo de Presupuesto Simple)")
+            st.info("La clasificación en Movilización, Directos, Indirectos, Utilidades se basa directamente en las filas leídas del archivo de presupuesto simple cargado.")
+
+            col1, col2 = st.columns(2)
+
+            if has_inv_data_to_display:
+                with col1:
+                     st.subheader("Temporada Invierno")
+                     # Ordered keys present in costs_inv, rendered as one element (absent keys add 0.0 to the total)
+                     keys_inv = eco_present_keys_inv
+                     total_inv = sum(values_inv)
+                     st.markdown("\n".join(f"- {key}: \\${costs_inv[key]:,.2f}" for key in keys_inv)) # Escaped $ so the joined lines are not read as LaTeX
+                     st.subheader(f"Total Calculado Invierno: ${total_inv:,.2f}")
+
+            if has_verano_data_to_display:
+                # Display verano costs in col2 if invierno data is present, otherwise in col1
+                with col2 if has_inv_data_to_display else col1:
+                    st.subheader("Temporada Verano")
+                    # Ordered keys present in costs_verano, rendered as one element (absent keys add 0.0 to the total)
+                    keys_verano = eco_present_keys_verano
+                    total_verano = sum(values_verano)
+                    st.markdown("\n".join(f"- {key}: \\${costs_verano[key]:,.2f}" for key in keys_verano)) # Escaped $ so the joined lines are not read as LaTeX
+                    st.subheader(f"Total Calculado Verano: ${total_verano:,.2f}")
+
+            # Specific message if file was processed but no non-zero relevant data found
+            # Check if eco_data is a dictionary and it was likely populated (even with zeros)
+            elif eco_has_seasons: # Check if keys exist even if values are zeroed
+                 st.info("El archivo de presupuesto simple fue procesado, pero no contiene datos de costos no cero para las categorías esperadas.")
+
+        else:
+            # Message when no file was uploaded or parsing failed critically
+            st.info("Por favor, carga el archivo de `presupuesto_simple.csv` para ver el análisis de costos.")
+
+        st.markdown("---")
+        st.subheader("Sobre la Definición de Costos Operativos")
+        st.info("El análisis de costos directos variables operativos, fijos directos/indirectos, etc. depende de cómo se clasifiquen y calculen estos costos en el archivo de entrada. El archivo simple clasifica por tipo principal (Directos, Indirectos, etc.), pero la determinación de su variabilidad, o fijeza debe hacerse al generar esos totales en el archivo origen (ej. Excel).")
 
 
 # --- TAB: Ratios Consumo / Eficiencia ---
 with tab_ratios:
-    st.header("Ratios de Consumo y Eficiencia")
-
-    # Check if fuel_df is loaded and has the required columns
-    required_fuel_cols_ratios = ['Equipo/Int.', 'Tipo de Comb.', 'Lts Egreso', 'Hs/Km_Numeric', 'Comentarios', 'Costo Unitario Lt', 'Costo Total Egreso', 'Fecha']
-
-    # Check if fuel_df is a DataFrame and has the necessary columns before proceeding
-    if isinstance(fuel_df, pd.DataFrame) and all(col in fuel_df.columns for col in required_fuel_cols_ratios):
-
-         if not fuel_df.empty: # Check if the DF actually contains rows
-
-            st.info("Los datos de consumo y eficiencia se basan en los registros con `LtsEgreso > 0.0` en el archivo de combustible.")
-
-            # --- Consumo Total por Equipo (Tabla y Gráfico de Barras) ---
-            st.subheader("Consumo Total de Combustible por Equipo (Lts)")
-
-            # Filter consumption rows: Lts Egreso > 0.0 and NOT marked as PRESTAMO
-            # Ensure Comentarios is string before contains check
-            consumption_mask = (fuel_df['Lts Egreso'] > 1e-9) & (~fuel_df['Comentarios'].astype(str).str.contains('PRESTAMO', na=False, case=False))
-            consumption_df = fuel_df[consumption_mask].copy()
-
-            if not consumption_df.empty:
-                 # Ensure required columns exist in the filtered dataframe (should be, but belt and suspenders)
-                 if all(col in consumption_df.columns for col in ['Equipo/Int.', 'Lts Egreso', 'Tipo de Comb.']):
-                      fuel_consumption_per_equipment = consumption_df.groupby('Equipo/Int.').agg(
-                          Total_Liters=('Lts Egreso', 'sum'),
-                          # Use .mode() with [0] to get the most frequent fuel type for this equipment, default if empty
-                          Tipo=('Tipo de Comb.', lambda x: x.mode()[0] if not x.empty else 'Multiple/Unknown')
-                      ).reset_index()
-
-                      if not fuel_consumption_per_equipment.empty and fuel_consumption_per_equipment['Total_Liters'].sum() > 1e-9: # Check if there's any consumption
-                          st.dataframe(fuel_consumption_per_equipment[['Equipo/Int.', 'Tipo', 'Total_Liters']].sort_values(by='Total_Liters', ascending=False).reset_index(drop=True), use_container_width=True) # Added drop=True to avoid index
-
-                          st.markdown("#### Gráfico de Consumo por Equipo")
-                          fig_consumo_equipo = px.bar(
-                              fuel_consumption_per_equipment.sort_values(by='Total_Liters', ascending=False),
-                              x='Equipo/Int.',
-                              y='Total_Liters',
-                              color='Tipo', # Color bars by fuel type
-                              title='Consumo Total de Litros por Equipo',
-                              labels={'Equipo/Int.': 'Equipo / Interno', 'Total_Liters': 'Litros Consumidos'}
-                          )
-                          fig_consumo_equipo.update_layout(xaxis={'categoryorder':'total descending'}) # Ensure bars are sorted
-                          st.plotly_chart(fig_consumo_equipo, use_container_width=True)
-
-                      else:
-                           st.info("El consumo total calculado por equipo es cero o insignificante.")
-                 else:
-                      st.warning("Columnas estándar requeridas ('Equipo/Int.', 'Lts Egreso' o 'Tipo de Comb.') faltantes en los datos filtrados de consumo.")
-            else:
-                 st.info("No se registraron egresos de combustible válidos (Lts Egreso > 0.0 y no es préstamo) para equipos en el archivo cargado.")
+    if tab_ratios.open:
+        st.header("Ratios de Consumo y Eficiencia")
 
-            st.markdown("---")
+        # Check if fuel_df is loaded and has the required columns
+        required_fuel_cols_ratios = ['Equipo/Int.', 'Tipo de Comb.', 'Lts Egreso', 'Hs/Km_Numeric', 'Comentarios', 'Costo Unitario Lt', 'Costo Total Egreso', 'Fecha', 'Es Prestamo', 'Lts / Uso']
 
-            # --- Costo de Combustible por Equipo (Bar Chart) ---
-            st.subheader("Costo de Combustible por Equipo ($)")
-            st.warning("Este cálculo requiere que la columna `CostoUnitarioLt` contenga valores numéricos válidos, > $0, en las filas con egresos (`LtsEgreso > 0`). Asegúrate que las líneas de egreso (`LtsEgreso > 0`) se correspondan a un costo.")
-
-            # Calculate total cost per equipment from rows with positive egress and positive Costo Total Egreso
-            cost_consumption_mask = (fuel_df['Costo Total Egreso'] > 1e-9) & (~fuel_df['Comentarios'].astype(str).str.contains('PRESTAMO', na=False, case=False))
-            cost_consumption_df = fuel_df[cost_consumption_mask].copy()
-
-            if not cost_consumption_df.empty:
-                 # Ensure required columns exist in the filtered dataframe
-                 if all(col in cost_consumption_df.columns for col in ['Equipo/Int.', 'Costo Total Egreso', 'Tipo de Comb.']):
-
-                      fuel_cost_per_equipment = cost_consumption_df.groupby('Equipo/Int.').agg(
-                          Total_Cost=('Costo Total Egreso', 'sum'),
-                          # Use .mode() with [0] to get the most frequent fuel type for this equipment
-                          Tipo=('Tipo de Comb.', lambda x: x.mode()[0] if not x.empty else 'Multiple/Unknown')
-                      ).reset_index()
-
-                      if not fuel_cost_per_equipment.empty and fuel_cost_per_equipment['Total_Cost'].sum() > 1e-9: # Check if there's any cost
-                          # Display Bar Chart for Cost by Equipment
-                          st.markdown("#### Gráfico de Costo por Equipo")
-                          fig_cost_per_equipo = px.bar(
-                              fuel_cost_per_equipment.sort_values(by='Total_Cost', ascending=False),
-                              x='Equipo/Int.',
-                              y='Total_Cost',
-                              color='Tipo', # Color bars by fuel type
-                              title='Costo Total de Combustible por Equipo ($)',
-                              labels={'Equipo/Int.': 'Equipo / Interno', 'Total_Cost': 'Costo Total ($)'}
-                          )
-                          fig_cost_per_equipo.update_layout(xaxis={'categoryorder':'total descending'}, yaxis_title="Costo ($)")
-                          st.plotly_chart(fig_cost_per_equipo, use_container_width=True)
-                      else:
-                           st.info("El costo total calculado por equipo es cero o insignificante (verifica valores de `CostoUnitarioLt` y `LtsEgreso`).")
-                 else:
-                     st.warning("Columnas requeridas ('Equipo/Int.', 'Costo Total Egreso' o 'Tipo de Comb.') faltantes en los datos filtrados de costo.")
-            else:
-                 st.info("No se registraron egresos de combustible con costo válido (> $0) por equipo.")
+        # Check if fuel_df is a DataFrame and has the necessary columns before proceeding
+        if isinstance(fuel_df, pd.DataFrame) and all(col in fuel_df.columns for col in required_fuel_cols_ratios):
 
+             if not fuel_df.empty: # Check if the DF actually contains rows
 
-            st.markdown("---")
+                st.info("Los datos de consumo y eficiencia se basan en los registros con `LtsEgreso > 0.0` en el archivo de combustible.")
+
+                # --- Consumo Total por Equipo (Tabla y Gráfico de Barras) ---
+                st.subheader("Consumo Total de Combustible por Equipo (Lts)")
+
+                # Consumption rows: Lts Egreso > 0.0 and NOT marked as PRESTAMO (cached aggregate).
+                # The cost aggregate used further below comes from the same cached call.
+                fuel_consumption_per_equipment, fuel_cost_per_equipment = get_session_derived('fuel_per_equipment', st.session_state.last_fuel_file_id, compute_fuel_per_equipment, fuel_df)
+
+                if not fuel_consumption_per_equipment.empty:
+                     if fuel_consumption_per_equipment['Total_Liters'].sum() > 1e-9: # Check if there's any consumption
+                         st.dataframe(fuel_consumption_per_equipment[['Equipo/Int.', 'Tipo', 'Total_Liters']].sort_values(by='Total_Liters', ascending=False).reset_index(drop=True), use_container_width=True) # Added drop=True to avoid index
 
-            # --- Ratios de Eficiencia (Lts/Hs o Lts/Km) Table ---
-            st.subheader("Registros de Consumo con Uso (Hs/Km) registrado")
-            st.warning("Para ver ratios, la columna `HsKm` debe contener un **valor numérico positivo** (> 0.0) asociado a los egresos de combustible.")
-
-            # Filter for rows where Lts Egreso > 0.0 AND Hs/Km_Numeric is valid (> 0)
-            usage_recorded_mask = (fuel_df['Lts Egreso'] > 1e-9) & (fuel_df['Hs/Km_Numeric'].notna()) & (fuel_df['Hs/Km_Numeric'] > 1e-9)
-            usage_recorded_df = fuel_df[usage_recorded_mask].copy()
-
-            if not usage_recorded_df.empty:
-                 # Ensure required columns exist in the filtered dataframe before calculating ratio
-                 required_cols_for_ratio_calc = ['Lts Egreso', 'Hs/Km_Numeric']
-                 if all(col in usage_recorded_df.columns for col in required_cols_for_ratio_calc):
-                      # Calculate ratio - Hs/Km_Numeric is guaranteed > 0 and notna() here by the mask
-                      usage_recorded_df['Lts / Uso'] = usage_recorded_df['Lts Egreso'] / usage_recorded_df['Hs/Km_Numeric']
-
-                      st.markdown("#### Registros con Ratios Calculados")
-                      display_cols = ['Fecha', 'Equipo/Int.', 'Lts Egreso', 'HsKm', 'Lts / Uso', 'Tipo de Comb.', 'Costo Total Egreso', 'Comentarios'] # Added Costo Total Egreso, ensure Equipo/Int. and Tipo de Comb exist
-                      display_cols = [col for col in display_cols if col in usage_recorded_df.columns] # Filter cols by actual presence in DF
-
-                      if display_cols:
-                           # Display DataFrame with calculated ratio
-                           st.dataframe(usage_recorded_df[display_cols].sort_values(by='Fecha', ascending=False).reset_index(drop=True), use_container_width=True, hide_index=True)
-                           st.info("Estos son los registros donde se pudo calcular un ratio (Lts / Uso). Si 'HsKm' representa horas, el ratio es Lts/Hora. Si representa kilómetros, es Lts/Km.")
-                      else:
-                           st.warning("Columnas necesarias para mostrar registros con uso válido faltantes ('Lts Egreso', 'HsKm', 'Hs/Km_Numeric').")
-
-                      # --- Efficiency Trend Line Chart ---
-                      st.markdown("#### Tendencia de Eficiencia (Lts / Uso) por Equipo")
-                      st.info("Mostrando tendencia solo para equipos con **2 o más registros de ratio válidos** para que se pueda dibujar una línea.")
-
-                      # Identify equipment with multiple data points for a line chart to make sense
-                      equipment_usage_counts = usage_recorded_df['Equipo/Int.'].value_counts() if 'Equipo/Int.' in usage_recorded_df.columns else pd.Series()
-                      equipos_for_trend = equipment_usage_counts[equipment_usage_counts >= 2].index.tolist()
-
-                      if equipos_for_trend and 'Fecha' in usage_recorded_df.columns and 'Lts / Uso' in usage_recorded_df.columns:
-                           # Allow selecting which equipment to show
-                           selected_equipos = st.multiselect(
-                               "Selecciona equipos para la tendencia:",
-                               options=equipos_for_trend,
-                               default=equipos_for_trend[:min(len(equipos_for_trend), 3)] # Select first 3 by default if available
-                           )
-
-                           if selected_equipos:
-                               # Filter the data for selected equipment and sort by date
-                               trend_df = usage_recorded_df[usage_recorded_df['Equipo/Int.'].isin(selected_equipos)].sort_values(by='Fecha').copy()
-
-                               if not trend_df.empty:
-                                    fig_trend_eficiencia = px.line(
-                                        trend_df,
-                                        x='Fecha',
-                                        y='Lts / Uso',
-                                        color='Equipo/Int.',
-                                        title='Tendencia de Eficiencia (Lts / Uso) por Equipo',
-                                        labels={'Lts / Uso': 'Litros por Unidad de Uso'}, # Generic label
-                                        markers=True # Show data points
-                                    )
-                                    fig_trend_eficiencia.update_layout(xaxis_title="Fecha", yaxis_title="Lts / Uso")
-                                    st.plotly_chart(fig_trend_eficiencia, use_container_width=True)
+                         st.markdown("#### Gráfico de Consumo por Equipo")
+                         fig_consumo_equipo = px.bar(
+                             fuel_consumption_per_equipment, # Bar order comes from categoryorder below, no pandas sort needed
+                             x='Equipo/Int.',
+                             y='Total_Liters',
+                             color='Tipo', # Color bars by fuel type
+                             title='Consumo Total de Litros por Equipo',
+                             labels={'Equipo/Int.': 'Equipo / Interno', 'Total_Liters': 'Litros Consumidos'}
+                         )
+                         fig_consumo_equipo.update_layout(xaxis={'categoryorder':'total descending'}) # Ensure bars are sorted
+                         st.plotly_chart(fig_consumo_equipo, use_container_width=True)
+
+                     else:
+                          st.info("El consumo total calculado por equipo es cero o insignificante.")
+                else:
+                     st.info("No se registraron egresos de combustible válidos (Lts Egreso > 0.0 y no es préstamo) para equipos en el archivo cargado.")
+
+                st.markdown("---")
+
+                # --- Costo de Combustible por Equipo (Bar Chart) ---
+                st.subheader("Costo de Combustible por Equipo ($)")
+                st.warning("Este cálculo requiere que la columna `CostoUnitarioLt` contenga valores numéricos válidos, > $0, en las filas con egresos (`LtsEgreso > 0`). Asegúrate que las líneas de egreso (`LtsEgreso > 0`) se correspondan a un costo.")
+
+                # fuel_cost_per_equipment: rows with positive Costo Total Egreso, excluding PRESTAMO (computed above)
+
+                if not fuel_cost_per_equipment.empty:
+                     if fuel_cost_per_equipment['Total_Cost'].sum() > 1e-9: # Check if there's any cost
+                         # Display Bar Chart for Cost by Equipment
+                         st.markdown("#### Gráfico de Costo por Equipo")
+                         fig_cost_per_equipo = px.bar(
+                             fuel_cost_per_equipment, # Bar order comes from categoryorder below, no pandas sort needed
+                             x='Equipo/Int.',
+                             y='Total_Cost',
+                             color='Tipo', # Color bars by fuel type
+                             title='Costo Total de Combustible por Equipo ($)',
+                             labels={'Equipo/Int.': 'Equipo / Interno', 'Total_Cost': 'Costo Total ($)'}
+                         )
+                         fig_cost_per_equipo.update_layout(xaxis={'categoryorder':'total descending'}, yaxis_title="Costo ($)")
+                         st.plotly_chart(fig_cost_per_equipo, use_container_width=True)
+                     else:
+                          st.info("El costo total calculado por equipo es cero o insignificante (verifica valores de `CostoUnitarioLt` y `LtsEgreso`).")
+                else:
+                     st.info("No se registraron egresos de combustible con costo válido (> $0) por equipo.")
+
+
+                st.markdown("---")
+
+                # --- Ratios de Eficiencia (Lts/Hs o Lts/Km) Table ---
+                st.subheader("Registros de Consumo con Uso (Hs/Km) registrado")
+                st.warning("Para ver ratios, la columna `HsKm` debe contener un **valor numérico positivo** (> 0.0) asociado a los egresos de combustible.")
+
+                # Rows where Lts Egreso > 0.0 AND Hs/Km_Numeric is valid (> 0); 'Lts / Uso' comes precomputed from the parser
+                usage_recorded_df = get_session_derived('fuel_usage_records', st.session_state.last_fuel_file_id, compute_fuel_usage_records, fuel_df)
+
+                if not usage_recorded_df.empty:
+                     # Ensure required columns exist in the filtered dataframe
+                     required_cols_for_ratio_calc = ['Lts Egreso', 'Hs/Km_Numeric']
+                     if all(col in usage_recorded_df.columns for col in required_cols_for_ratio_calc):
+                          st.markdown("#### Registros con Ratios Calculados")
+                          display_cols = ['Fecha', 'Equipo/Int.', 'Lts Egreso', 'HsKm', 'Lts / Uso', 'Tipo de Comb.', 'Costo Total Egreso', 'Comentarios'] # Added Costo Total Egreso, ensure Equipo/Int. and Tipo de Comb exist
+                          display_cols = [col for col in display_cols if col in usage_recorded_df.columns] # Filter cols by actual presence in DF
+
+                          if display_cols:
+                               # Display DataFrame with calculated ratio
+                               st.dataframe(usage_recorded_df[display_cols].sort_values(by='Fecha', ascending=False).reset_index(drop=True), use_container_width=True, hide_index=True)
+                               st.info("Estos son los registros donde se pudo calcular un ratio (Lts / Uso). Si 'HsKm' representa horas, el ratio es Lts/Hora. Si representa kilómetros, es Lts/Km.")
+                          else:
+                               st.warning("Columnas necesarias para mostrar registros con uso válido faltantes ('Lts Egreso', 'HsKm', 'Hs/Km_Numeric').")
+
+                          # --- Efficiency Trend Line Chart ---
+                          st.markdown("#### Tendencia de Eficiencia (Lts / Uso) por Equipo")
+                          st.info("Mostrando tendencia solo para equipos con **2 o más registros de ratio válidos** para que se pueda dibujar una línea.")
+
+                          # Identify equipment with multiple data points for a line chart to make sense
+                          # Equipments with >= 2 records, most records first (cached per fuel file)
+                          equipos_for_trend = get_session_derived('equipos_for_trend', st.session_state.last_fuel_file_id, compute_equipos_for_trend, usage_recorded_df)
+
+                          if equipos_for_trend and 'Fecha' in usage_recorded_df.columns and 'Lts / Uso' in usage_recorded_df.columns:
+                               # Allow selecting which equipment to show. The choice is kept in a non-widget session entry
+                               # (written by the on_change callback), so it survives switching to another tab and back
+                               if st.session_state.trend_equipos_selected is None:
+                                    default_equipos = equipos_for_trend[:min(len(equipos_for_trend), 3)] # Select first 3 by default if available
                                else:
-                                   st.info("No hay datos de ratio válidos para los equipos seleccionados.")
-                           else:
-                               st.info("Selecciona al menos un equipo para ver la tendencia de eficiencia.")
+                                    default_equipos = [equipo for equipo in st.session_state.trend_equipos_selected if equipo in equipos_for_trend]
+                               selected_equipos = st.multiselect(
+                                   "Selecciona equipos para la tendencia:",
+                                   options=equipos_for_trend,
+                                   default=default_equipos,
+                                   key='trend_equipos_widget',
+                                   on_change=remember_trend_selection
+                               )
 
-                      else:
-                            st.info("No hay equipos con suficientes registros (2 o más) con ratios válidos y fecha para mostrar una tendencia, o faltan columnas ('Fecha', 'Lts / Uso', 'Equipo/Int.').")
+                               if selected_equipos:
+                                   # Records of the selected equipment, already in date order. Kept in session state for the
+                                   # current fuel file and selection (the sorted tuple, so selection order doesn't matter)
+                                   positions_by_equipment = get_session_derived('usage_positions_by_equipment', st.session_state.last_fuel_file_id, compute_usage_positions_by_equipment, usage_recorded_df)
+                                   trend_key = (st.session_state.last_fuel_file_id, tuple(sorted(selected_equipos)))
+                                   trend_df = get_session_derived('trend_records', trend_key, compute_trend_records, usage_recorded_df, positions_by_equipment, trend_key[1])
+
+                                   if not trend_df.empty:
+                                        fig_trend_eficiencia = px.line(
+                                            trend_df,
+                                            x='Fecha',
+                                            y='Lts / Uso',
+                                            color='Equipo/Int.',
+                                            title='Tendencia de Eficiencia (Lts / Uso) por Equipo',
+                                            labels={'Lts / Uso': 'Litros por Unidad de Uso'}, # Generic label
+                                            markers=True, # Show data points
+                                            render_mode='webgl' # WebGL traces draw long series faster in the browser
+                                        )
+                                        fig_trend_eficiencia.update_layout(xaxis_title="Fecha", yaxis_title="Lts / Uso")
+                                        st.plotly_chart(fig_trend_eficiencia, use_container_width=True)
+                                   else:
+                                       st.info("No hay datos de ratio válidos para los equipos seleccionados.")
+                               else:
+                                   st.info("Selecciona al menos un equipo para ver la tendencia de eficiencia.")
 
-                 else:
-                      st.warning("Columnas necesarias para calcular ratios ('Lts Egreso', 'Hs/Km_Numeric') faltantes.")
+                          else:
+                                st.info("No hay equipos con suficientes registros (2 o más) con ratios válidos y fecha para mostrar una tendencia, o faltan columnas ('Fecha', 'Lts / Uso', 'Equipo/Int.').")
 
-            else:
-                 st.info("No hay registros de egresos de combustible válidos (> 0.0) que también tengan un valor numérico válido y mayor a cero en la columna 'HsKm'.")
+                     else:
+                          st.warning("Columnas necesarias para calcular ratios ('Lts Egreso', 'Hs/Km_Numeric') faltantes.")
+
+                else:
+                     st.info("No hay registros de egresos de combustible válidos (> 0.0) que también tengan un valor numérico válido y mayor a cero en la columna 'HsKm'.")
 
 
-         else: # fuel_df exists but is empty
-             st.info("El archivo de Combustible fue cargado, pero no contiene ninguna fila de datos válida.")
-             st.warning("Asegúrate de que el archivo `combustible_simple_v2.csv` tenga filas debajo de la cabecera de datos ('Fecha,Equipo,...') que no estén vacías o mal formadas, y que incluyan al menos una `Fecha`, un `Equipo` y un `CodigoCombustible` válidos.")
+             else: # fuel_df exists but is empty
+                 st.info("El archivo de Combustible fue cargado, pero no contiene ninguna fila de datos válida.")
+                 st.warning("Asegúrate de que el archivo `combustible_simple_v2.csv` tenga filas debajo de la cabecera de datos ('Fecha,Equipo,...') que no estén vacías o mal formadas, y que incluyan al menos una `Fecha`, un `Equipo` y un `CodigoCombustible` válidos.")
 
-    else: # fuel_df is None or not a DataFrame, or missing required columns after parsing (handled by the initial check)
-        # Check specifically if it's a DataFrame that's missing columns vs. None
-        if isinstance(fuel_df, pd.DataFrame) and required_fuel_cols_ratios and not all(col in fuel_df.columns for col in required_fuel_cols_ratios):
-            missing_cols = [col for col in required_fuel_cols_ratios if col not in fuel_df.columns]
-            st.error(f"El archivo de Combustible fue cargado, pero faltan columnas esenciales para el análisis de ratios: {', '.join(missing_cols)}. Revisa el formato.")
-        else: # It's None, or some other state indicating critical failure/no file
-            st.info("Por favor, carga el archivo `combustible_simple_v2.csv` para ver los datos de consumo y ratios.")
+        else: # fuel_df is None or not a DataFrame, or missing required columns after parsing (handled by the initial check)
+            # Check specifically if it's a DataFrame that's missing columns vs. None
+            if isinstance(fuel_df, pd.DataFrame) and required_fuel_cols_ratios and not all(col in fuel_df.columns for col in required_fuel_cols_ratios):
+                missing_cols = [col for col in required_fuel_cols_ratios if col not in fuel_df.columns]
+                st.error(f"El archivo de Combustible fue cargado, pero faltan columnas esenciales para el análisis de ratios: {', '.join(missing_cols)}. Revisa el formato.")
+            else: # It's None, or some other state indicating critical failure/no file
+                st.info("Por favor, carga el archivo `combustible_simple_v2.csv` para ver los datos de consumo y ratios.")
 
 
-    st.markdown("---")
-    st.subheader("Sugerencias para Mejorar Ratios de Consumo y Eficiencia")
-    st.markdown("""
-        - Asegúrate de que para CADA registro de Egreso (`LtsEgreso > 0.0`) se complete un **valor numérico positivo** (`> 0`) en la columna **`HsKm`** para calcular ratios Lts/Uso.
-        - La columna **`CostoUnitarioLt`** es necesaria para los gráficos de costo. Ingresa el costo en la línea de ingreso (`LtsIngreso > 0`) del combustible.
-        - La funcionalidad actual calcula Costo Total Egreso por línea (`LtsEgreso * CostoUnitarioLt`). Se asume que `CostoUnitarioLt` en una fila de egreso representa el costo del combustible egresado en ese movimiento. Para un cálculo de costo de egreso basado en el costo promedio del stock en el momento del egreso, se necesitaría un registro de stock histórico más complejo.
-    """)
+        st.markdown("---")
+        st.subheader("Sugerencias para Mejorar Ratios de Consumo y Eficiencia")
+        st.markdown("""
+            - Asegúrate de que para CADA registro de Egreso (`LtsEgreso > 0.0`) se complete un **valor numérico positivo** (`> 0`) en la columna **`HsKm`** para calcular ratios Lts/Uso.
+            - La columna **`CostoUnitarioLt`** es necesaria para los gráficos de costo. Ingresa el costo en la línea de ingreso (`LtsIngreso > 0`) del combustible.
+            - La funcionalidad actual calcula Costo Total Egreso por línea (`LtsEgreso * CostoUnitarioLt`). Se asume que `CostoUnitarioLt` en una fila de egreso representa el costo del combustible egresado en ese movimiento. Para un cálculo de costo de egreso basado en el costo promedio del stock en el momento del egreso, se necesitaría un registro de stock histórico más complejo.
+        """)
 
 
 # --- TAB: Gráfico de Cascada ---
 with tab_waterfall:
-    st.header("Visualización de Costos (Gráfico de Cascada)")
-
-    # Get cost data from eco_data, defaulting to empty dicts if keys are missing (handled by default structure now)
-    costs_inv = eco_data.get('invierno', {})
-    costs_verano = eco_data.get('verano', {})
-
-    # Use the defined order of categories for waterfall steps
-    ordered_categories_internal_keys = ['Movilizacion', 'Costos Directos', 'Costos Indirectos/Generales', 'Utilidades']
-
-    # Check if eco_data is a dictionary and if there is any non-zero relevant data for Invierno breakdown
-    has_inv_data_to_breakdown = isinstance(costs_inv, dict) and any(abs(costs_inv.get(k, 0.0)) > 1e-9 for k in ordered_categories_internal_keys)
-
-    if has_inv_data_to_breakdown:
-        st.subheader("Desglose de Costos Temporada Invierno")
-
-        # Data for the Waterfall chart for Invierno Breakdown
-        waterfall_labels_inv = []
-        waterfall_values_inv = []
-        waterfall_measures_inv = []
-        waterfall_text_inv = []
-
-        # Add starting base
-        waterfall_labels_inv.append("Inicio Base")
-        waterfall_values_inv.append(0.0) # Starts at 0
-        waterfall_measures_inv.append('absolute')
-        waterfall_text_inv.append("$0")
-
-
-        relative_steps_added = 0 # Count how many relative steps (categories) are non-zero
-        # Iterate over ordered keys, ensuring they exist in costs_inv dict
-        for internal_key in [k for k in ordered_categories_internal_keys if k in costs_inv]:
-             label = internal_key
-             value = costs_inv.get(internal_key, 0.0) # Get value, default to 0.0
-
-             if abs(value) > 1e-9: # Only add steps with non-zero values
-                 waterfall_labels_inv.append(label)
-                 waterfall_values_inv.append(value)
-                 waterfall_measures_inv.append('relative') # Relative step
-                 waterfall_text_inv.append(f"${value:,.0f}") # Text for display on chart
-                 relative_steps_added += 1 # Increment counter
-
-
-        # Calculate the total *after* processing all categories (summing only keys present in costs_inv)
-        total_inv_calculated = sum(costs_inv.get(k, 0.0) for k in [k for k in ordered_categories_internal_keys if k in costs_inv])
-
-
-        # Add the final total bar ONLY if there were relative steps OR the total is non-zero
-        if relative_steps_added > 0 or abs(total_inv_calculated) > 1e-9: # Ensure there is something meaningful to show
-             # Add the final 'Total Invierno' bar
-             waterfall_labels_inv.append("Total Invierno Calculado")
-             waterfall_values_inv.append(total_inv_calculated) # Final value
-             waterfall_measures_inv.append('total') # This MUST be 'total' measure for Plotly waterfall end bar
-             waterfall_text_inv.append(f"${total_inv_calculated:,.0f}")
-
-
-        # Check if there are enough points to plot a waterfall (at least base + total, or base + 1 relative)
-        # len(waterfall_labels_inv) > 1 is a sufficient check after adding base and potential relative/total bars
-        if len(waterfall_labels_inv) > 1:
-             fig_inv = go.Figure(go.Waterfall(
-                 name = "Costos Invierno",
-                 orientation = "v", # Vertical waterfall
-                 measure = waterfall_measures_inv,
-                 x = waterfall_labels_inv, # Categories / Step labels
-                 y = waterfall_values_inv, # Values for each step
-                 textposition = "outside", # Position of text labels on bars
-                 text = waterfall_text_inv, # Text content for labels
-                 connector = {"line": {"color": "rgb(63, 63, 63)"}}, # Style connector lines
-                 # Marker colors: Default for relative, specify for 'total' bars via 'totals'
-                 # increasing = {"marker":{"color": "forestgreen"}}, # Optional: custom color for increasing steps
-                 # decreasing = {"marker":{"color": "crimson"}}, # Optional: custom color for decreasing steps
-                 totals = {"marker": {"color": "royalblue", "line": {"color": "royalblue", "width": 2}}} # Style for 'total' bars (Start/End totals)
-             ))
-
-             fig_inv.update_layout(
-                 title = "Gráfico de Cascada de Costos - Temporada Invierno (Desglose por Categoría)",
-                 showlegend = False,
-                 yaxis_title="Monto ($)",
-                 margin=dict(l=20, r=20, t=40, b=20), # Adjust margins
-                 hovermode="x unified", # Improve hover experience
-             )
-             st.plotly_chart(fig_inv, use_container_width=True)
-
-        # Message if data is present but totals/steps are all zero/insignificant
-        # Check if costs_inv is a dict before checking its content
-        elif isinstance(costs_inv, dict) and any(abs(costs_inv.get(k, 0.0)) > 1e-9 for k in [k for k in ordered_categories_internal_keys if k in costs_inv]):
-             st.info(f"El archivo de presupuesto para Invierno fue procesado. Sin embargo, las categorías individuales suman cero o son muy pequeñas para visualizar un desglose detallado en el gráfico de cascada.")
-             st.write(f"Total calculado Invierno: ${total_inv_calculated:,.2f}")
-
-
-    st.markdown("---")
-    # --- Comparison Waterfall (Invierno vs. Verano) ---
-    st.subheader("Comparación de Costos: Invierno vs. Verano")
-
-    # Check if data for *both* seasons is available and relevant (ensure costs_inv/verano are dicts)
-    has_both_seasons_data_parsed = isinstance(costs_inv, dict) and isinstance(costs_verano, dict)
-
-    # Calculate total sums for comparison (summing only keys present in respective dicts)
-    total_invierno_comp = sum(costs_inv.get(k, 0.0) for k in [k for k in ordered_categories_internal_keys if k in costs_inv])
-    total_verano_comp = sum(costs_verano.get(k, 0.0) for k in [k for k in ordered_categories_internal_keys if k in costs_verano])
-
-
-    # Check if the overall totals are significantly different OR if category differences exist
-    difference_between_totals_exists = abs(total_invierno_comp - total_verano_comp) > 1e-9
-
-    category_differences_exist_in_comparison = False
-    if has_both_seasons_data_parsed:
-         for category in ordered_categories_internal_keys:
-              # Check if the category key exists in *both* dictionaries before comparing
-              if category in costs_inv and category in costs_verano:
-                   inv_val = costs_inv.get(category, 0.0)
-                   verano_val = costs_verano.get(category, 0.0)
-                   if abs(verano_val - inv_val) > 1e-9: # Check for significant difference
-                        category_differences_exist_in_comparison = True
-                        break # Found at least one significant difference
-
-    # Trigger comparison waterfall display if both seasons data dictionaries are available AND there's something interesting to show
-    # Interesting could be: the total changes, or individual categories change even if total doesn't, or just show totals if both exist.
-    if has_both_seasons_data_parsed and (difference_between_totals_exists or category_differences_exist_in_comparison or abs(total_invierno_comp) > 1e-9 or abs(total_verano_comp) > 1e-9):
-
-         # Data for the Comparison Waterfall
-         diff_labels = []
-         diff_values = []
-         diff_measures = []
-         diff_text_values = []
-
-         # Start with the base Winter total IF it's non-zero, or if the comparison makes sense
-         # Only add the base bar if the starting total is non-zero OR there's a total change OR category changes will be shown.
-         if abs(total_invierno_comp) > 1e-9 or difference_between_totals_exists or category_differences_exist_in_comparison:
-              diff_labels.append("Total Invierno Base")
-              diff_values.append(total_invierno_comp)
-              diff_measures.append('absolute') # The base is an absolute value
-              diff_text_values.append(f"${total_invierno_comp:,.0f}")
-
-         # Add relative steps for the change in each category from Invierno to Verano
-         added_comparison_diff_steps = 0 # Count significant changes added as relative steps
-         for category in ordered_categories_internal_keys:
-              # Only calculate difference if the category key exists in *both* dictionaries
-              if category in costs_inv and category in costs_verano:
-                   inv_val = costs_inv.get(category, 0.0)
-                   verano_val = costs_verano.get(category, 0.0)
-                   difference = verano_val - inv_val
-
-                   if abs(difference) > 1e-9: # Only add relative step if there's a significant change
-                        label = f"Cambio en {category}"
-                        diff_labels.append(label)
-                        diff_values.append(difference) # The difference value
-                        diff_measures.append('relative') # Relative step (change)
-                        sign = '+' if difference > 0 else '' # Add sign for positive values in text
-                        diff_text_values.append(f"{sign}${difference:,.0f}") # Formatted text for the bar
-                        added_comparison_diff_steps += 1 # Increment count
-
-         # Add the final total bar (Total Verano) IF there were changes OR the totals are non-zero
-         if abs(total_verano_comp) > 1e-9 or added_comparison_diff_steps > 0 or abs(total_invierno_comp) > 1e-9:
-               # Only add the final 'Total Verano' if there was a base bar (meaning diff_labels is not empty)
-               # OR if the final total is non-zero even if the base was zero
-              if diff_labels or abs(total_verano_comp) > 1e-9: # Add end bar if there's a start or a non-zero end
-                   diff_labels.append("Total Verano Final") # Clear label for end total
-                   diff_values.append(total_verano_comp) # Final value
-                   diff_measures.append('total') # MUST be 'total' for the end bar
-                   diff_text_values.append(f"${total_verano_comp:,.0f}")
-
-
-         # Check if there are enough points to plot the comparison waterfall (at least base + final, or base + 1 relative)
-         if len(diff_labels) > 1:
-              fig_diff = go.Figure(go.Waterfall(
-                 name = "Diferencia",
-                 orientation = "v",
-                 measure = diff_measures,
-                 x = diff_labels,
-                 y = diff_values,
-                 textposition = "outside",
-                 text = diff_text_values,
-                 connector = {"line": {"color": "rgb(63, 63, 63)"}},
-                 # Optional: color increasing/decreasing steps (changes)
-                 increasing = {"marker":{"color": "forestgreen"}},
-                 decreasing = {"marker":{"color": "crimson"}},
-                 # Style for the 'absolute'/'total' bars (Start/End totals)
-                 totals = {"marker": {"color": "darkblue", "line": {"color": "darkblue", "width": 2}}} # Corrected parameter name and structure
-              ))
-
-              fig_diff.update_layout(
-                 title = "Gráfico de Cascada - Comparación de Costos: Invierno vs. Verano",
-                 showlegend = False,
-                 yaxis_title="Monto ($)",
-                 margin=dict(l=20, r=20, t=40, b=20),
-                 hovermode="x unified",
-              )
-              st.plotly_chart(fig_diff, use_container_width=True)
-
-         # Provide informative messages for edge cases where data exists but comparison isn't drawn
-         elif has_both_seasons_data_parsed:
-              if abs(total_invierno_comp - total_verano_comp) < 1e-9 and not category_differences_exist_in_comparison:
-                   st.info(f"El Total Invierno (${total_invierno_comp:,.2f}) es igual al Total Verano (${total_verano_comp:,.2f}). No se encontraron diferencias significativas a nivel de estas categorías principales para graficar un desglose del cambio.")
-              elif abs(total_invierno_comp) > 1e-9 or abs(total_verano_comp) > 1e-9: # Data present and non-zero totals, but no category diff or total diff.
-                  st.info("Datos de ambas temporadas presentes. Los totales pueden ser diferentes o iguales, pero no se detectaron cambios significativos en las categorías principales ('Movilización', 'Costos Directos', etc.) para graficar un desglose del cambio.")
-                  st.write(f"Total Invierno: ${total_invierno_comp:,.2f}")
-                  st.write(f"Total Verano: ${total_verano_comp:,.2f}")
-              else: # Both totals are zero or insignificant, and no category differences
-                   st.info("Datos de ambas temporadas presentes, pero los totales y las diferencias por categoría son cero o insignificantes.")
-
-
-    # Message when eco_data is a dictionary, but data for both seasons or relevant data is missing
-    # Check if eco_data is a dictionary before checking its structure keys
-    elif isinstance(eco_data, dict) and (eco_data.get('invierno') is not None or eco_data.get('verano') is not None):
-         st.info("Archivo de presupuesto simple cargado y procesado. Para la comparación Invierno vs. Verano, verifica que el archivo contenga filas para las categorías esperadas ('Movilizacion', 'CostosDirectos', etc.) y que tengan valores no cero para ambas temporadas, o al menos en una temporada con un total diferente de cero.")
-
-    # Message when no eco file is loaded or parsing failed critically (eco_data is the default structured dict with zeros)
-    else: # eco_data is the default zeroed structure, indicating no file loaded or critical parse error
-        st.info("Por favor, carga el archivo de `presupuesto_simple.csv` para generar los gráficos de cascada de costos.")
-
-    st.markdown("---")
-    st.subheader("Sugerencias para Gráficos de Cascada Adicionales")
-    st.warning("Con el archivo de presupuesto simple actual, solo se pueden generar los gráficos de desglose y comparación entre temporadas. Para 'Presupuesto vs. Real' o 'Costos Históricos', necesitarías datos adicionales.")
-    st.markdown("""
-        - **Datos de Costos Reales:** Un archivo simple similar con los costos **REALES** incurridos para la comparación "Presupuesto vs. Real".
-        - **Costos Históricos por Período:** Archivos de presupuesto (y/o reales) para cada período o un archivo consolidado con una columna 'Período' para el análisis histórico.
-    """)
+    if tab_waterfall.open:
+        st.header("Visualización de Costos (Gráfico de Cascada)")
+
+        # Get cost data from eco_data, defaulting to empty dicts if keys are missing (handled by default structure now)
+        costs_inv = eco_data.get('invierno', {})
+        costs_verano = eco_data.get('verano', {})
+
+        # Use the defined order of categories for waterfall steps
+        ordered_categories_internal_keys = ECO_CATEGORY_KEYS
+
+        # Non-zero category steps, totals and category changes of both seasons: computed once for both
+        # waterfalls and kept in session state per eco file, so reruns from unrelated widgets reuse them
+        eco_summary = get_session_derived(
+            'eco_waterfall_summary', st.session_state.last_eco_file_id, compute_eco_waterfall_summary,
+            costs_inv if isinstance(costs_inv, dict) else {},
+            costs_verano if isinstance(costs_verano, dict) else {},
+            tuple(ordered_categories_internal_keys)
+        )
+        step_labels_inv, step_values_inv = eco_summary['step_labels_inv'], eco_summary['step_values_inv']
+        total_inv_calculated, total_verano_comp = eco_summary['total_inv'], eco_summary['total_verano']
+
+        # Check if there is any non-zero relevant data for Invierno breakdown
+        has_inv_data_to_breakdown = len(step_labels_inv) > 0
+
+        if has_inv_data_to_breakdown:
+            st.subheader("Desglose de Costos Temporada Invierno")
+
+            # Data for the Waterfall chart for Invierno Breakdown: starting base (absolute 0) followed by
+            # one relative step per non-zero category (from build_waterfall_steps above)
+            relative_steps_added = len(step_labels_inv)
+            waterfall_labels_inv = ["Inicio Base"] + step_labels_inv
+            waterfall_values_inv = [0.0] + step_values_inv.tolist()
+            waterfall_measures_inv = ['absolute'] + ['relative'] * relative_steps_added
+            waterfall_text_inv = ["$0"] + eco_summary['step_texts_inv']
+
+
+            # Add the final total bar ONLY if there were relative steps OR the total is non-zero
+            if relative_steps_added > 0 or abs(total_inv_calculated) > 1e-9: # Ensure there is something meaningful to show
+                 # Add the final 'Total Invierno' bar
+                 waterfall_labels_inv.append("Total Invierno Calculado")
+                 waterfall_values_inv.append(total_inv_calculated) # Final value
+                 waterfall_measures_inv.append('total') # This MUST be 'total' measure for Plotly waterfall end bar
+                 waterfall_text_inv.append(f"${total_inv_calculated:,.0f}")
+
+
+            # Check if there are enough points to plot a waterfall (at least base + total, or base + 1 relative)
+            # len(waterfall_labels_inv) > 1 is a sufficient check after adding base and potential relative/total bars
+            if len(waterfall_labels_inv) > 1:
+                 fig_inv = go.Figure(go.Waterfall(
+                     name = "Costos Invierno",
+                     orientation = "v", # Vertical waterfall
+                     measure = waterfall_measures_inv,
+                     x = waterfall_labels_inv, # Categories / Step labels
+                     y = waterfall_values_inv, # Values for each step
+                     textposition = "outside", # Position of text labels on bars
+                     text = waterfall_text_inv, # Text content for labels
+                     connector = {"line": {"color": "rgb(63, 63, 63)"}}, # Style connector lines
+                     # Marker colors: Default for relative, specify for 'total' bars via 'totals'
+                     # increasing = {"marker":{"color": "forestgreen"}}, # Optional: custom color for increasing steps
+                     # decreasing = {"marker":{"color": "crimson"}}, # Optional: custom color for decreasing steps
+                     totals = {"marker": {"color": "royalblue", "line": {"color": "royalblue", "width": 2}}} # Style for 'total' bars (Start/End totals)
+                 ))
+
+                 fig_inv.update_layout(
+                     title = "Gráfico de Cascada de Costos - Temporada Invierno (Desglose por Categoría)",
+                     showlegend = False,
+                     yaxis_title="Monto ($)",
+                     margin=dict(l=20, r=20, t=40, b=20), # Adjust margins
+                     hovermode="x unified", # Improve hover experience
+                 )
+                 st.plotly_chart(fig_inv, use_container_width=True)
+
+            # Message if data is present but totals/steps are all zero/insignificant
+            # Check if costs_inv is a dict before checking its content
+            elif relative_steps_added > 0:
+                 st.info(f"El archivo de presupuesto para Invierno fue procesado. Sin embargo, las categorías individuales suman cero o son muy pequeñas para visualizar un desglose detallado en el gráfico de cascada.")
+                 st.write(f"Total calculado Invierno: ${total_inv_calculated:,.2f}")
+
+
+        st.markdown("---")
+        # --- Comparison Waterfall (Invierno vs. Verano) ---
+        st.subheader("Comparación de Costos: Invierno vs. Verano")
+
+        # Check if data for *both* seasons is available and relevant (ensure costs_inv/verano are dicts)
+        has_both_seasons_data_parsed = isinstance(costs_inv, dict) and isinstance(costs_verano, dict)
+
+        # Total sums for comparison (summing only keys present in respective dicts), computed above
+        total_invierno_comp = total_inv_calculated
+
+        # Check if the overall totals are significantly different OR if category differences exist
+        difference_between_totals_exists = abs(total_invierno_comp - total_verano_comp) > 1e-9
+
+        # Significant per-category changes Verano - Invierno (categories present in *both* dictionaries), from the summary
+        change_labels, change_values = eco_summary['change_labels'], eco_summary['change_values']
+        category_differences_exist_in_comparison = has_both_seasons_data_parsed and len(change_labels) > 0
+
+        # Trigger comparison waterfall display if both seasons data dictionaries are available AND there's something interesting to show
+        # Interesting could be: the total changes, or individual categories change even if total doesn't, or just show totals if both exist.
+        if has_both_seasons_data_parsed and (difference_between_totals_exists or category_differences_exist_in_comparison or abs(total_invierno_comp) > 1e-9 or abs(total_verano_comp) > 1e-9):
+
+             # Data for the Comparison Waterfall
+             diff_labels = []
+             diff_values = []
+             diff_measures = []
+             diff_text_values = []
+
+             # Start with the base Winter total IF it's non-zero, or if the comparison makes sense
+             # Only add the base bar if the starting total is non-zero OR there's a total change OR category changes will be shown.
+             if abs(total_invierno_comp) > 1e-9 or difference_between_totals_exists or category_differences_exist_in_comparison:
+                  diff_labels.append("Total Invierno Base")
+                  diff_values.append(total_invierno_comp)
+                  diff_measures.append('absolute') # The base is an absolute value
+                  diff_text_values.append(f"${total_invierno_comp:,.0f}")
+
+             # Add relative steps for the significant change in each category from Invierno to Verano
+             added_comparison_diff_steps = len(change_labels)
+             diff_labels.extend(f"Cambio en {category}" for category in change_labels)
+             diff_values.extend(change_values.tolist())
+             diff_measures.extend(['relative'] * added_comparison_diff_steps)
+             diff_text_values.extend(eco_summary['change_texts']) # Pre-formatted, with sign for positive values
+
+             # Add the final total bar (Total Verano) IF there were changes OR the totals are non-zero
+             if abs(total_verano_comp) > 1e-9 or added_comparison_diff_steps > 0 or abs(total_invierno_comp) > 1e-9:
+                   # Only add the final 'Total Verano' if there was a base bar (meaning diff_labels is not empty)
+                   # OR if the final total is non-zero even if the base was zero
+                  if diff_labels or abs(total_verano_comp) > 1e-9: # Add end bar if there's a start or a non-zero end
+                       diff_labels.append("Total Verano Final") # Clear label for end total
+                       diff_values.append(total_verano_comp) # Final value
+                       diff_measures.append('total') # MUST be 'total' for the end bar
+                       diff_text_values.append(f"${total_verano_comp:,.0f}")
+
+
+             # Check if there are enough points to plot the comparison waterfall (at least base + final, or base + 1 relative)
+             if len(diff_labels) > 1:
+                  fig_diff = go.Figure(go.Waterfall(
+                     name = "Diferencia",
+                     orientation = "v",
+                     measure = diff_measures,
+                     x = diff_labels,
+                     y = diff_values,
+                     textposition = "outside",
+                     text = diff_text_values,
+                     connector = {"line": {"color": "rgb(63, 63, 63)"}},
+                     # Optional: color increasing/decreasing steps (changes)
+                     increasing = {"marker":{"color": "forestgreen"}},
+                     decreasing = {"marker":{"color": "crimson"}},
+                     # Style for the 'absolute'/'total' bars (Start/End totals)
+                     totals = {"marker": {"color": "darkblue", "line": {"color": "darkblue", "width": 2}}} # Corrected parameter name and structure
+                  ))
+
+                  fig_diff.update_layout(
+                     title = "Gráfico de Cascada - Comparación de Costos: Invierno vs. Verano",
+                     showlegend = False,
+                     yaxis_title="Monto ($)",
+                     margin=dict(l=20, r=20, t=40, b=20),
+                     hovermode="x unified",
+                  )
+                  st.plotly_chart(fig_diff, use_container_width=True)
+
+             # Provide informative messages for edge cases where data exists but comparison isn't drawn
+             elif has_both_seasons_data_parsed:
+                  if abs(total_invierno_comp - total_verano_comp) < 1e-9 and not category_differences_exist_in_comparison:
+                       st.info(f"El Total Invierno (${total_invierno_comp:,.2f}) es igual al Total Verano (${total_verano_comp:,.2f}). No se encontraron diferencias significativas a nivel de estas categorías principales para graficar un desglose del cambio.")
+                  elif abs(total_invierno_comp) > 1e-9 or abs(total_verano_comp) > 1e-9: # Data present and non-zero totals, but no category diff or total diff.
+                      st.info("Datos de ambas temporadas presentes. Los totales pueden ser diferentes o iguales, pero no se detectaron cambios significativos en las categorías principales ('Movilización', 'Costos Directos', etc.) para graficar un desglose del cambio.")
+                      st.write(f"Total Invierno: ${total_invierno_comp:,.2f}")
+                      st.write(f"Total Verano: ${total_verano_comp:,.2f}")
+                  else: # Both totals are zero or insignificant, and no category differences
+                       st.info("Datos de ambas temporadas presentes, pero los totales y las diferencias por categoría son cero o insignificantes.")
+
+
+        # Message when eco_data is a dictionary, but data for both seasons or relevant data is missing
+        # Check if eco_data is a dictionary before checking its structure keys
+        elif eco_has_seasons:
+             st.info("Archivo de presupuesto simple cargado y procesado. Para la comparación Invierno vs. Verano, verifica que el archivo contenga filas para las categorías esperadas ('Movilizacion', 'CostosDirectos', etc.) y que tengan valores no cero para ambas temporadas, o al menos en una temporada con un total diferente de cero.")
+
+        # Message when no eco file is loaded or parsing failed critically (eco_data is the default structured dict with zeros)
+        else: # eco_data is the default zeroed structure, indicating no file loaded or critical parse error
+            st.info("Por favor, carga el archivo de `presupuesto_simple.csv` para generar los gráficos de cascada de costos.")
+
+        st.markdown("---")
+        st.subheader("Sugerencias para Gráficos de Cascada Adicionales")
+        st.warning("Con el archivo de presupuesto simple actual, solo se pueden generar los gráficos de desglose y comparación entre temporadas. Para 'Presupuesto vs. Real' o 'Costos Históricos', necesitarías datos adicionales.")
+        st.markdown("""
+            - **Datos de Costos Reales:** Un archivo simple similar con los costos **REALES** incurridos para la comparación "Presupuesto vs. Real".
+            - **Costos Históricos por Período:** Archivos de presupuesto (y/o reales) para cada período o un archivo consolidado con una columna 'Período' para el análisis histórico.
+        """)
 
 
 # --- TAB: Gestión de Stock ---
 with tab_stock:
-    st.header("Gestión de Stock (Catálogo e Inventario)")
-
-    # Check if stock_df is a DataFrame and is loaded (can be empty but structured)
-    if isinstance(stock_df, pd.DataFrame): # Check if parsing was successful at all (returned a DF)
-        if not stock_df.empty: # Check if the DF has rows
-
-            st.subheader("Catálogo de Items")
-            # Define columns to display for the basic catalog, filter by presence in DF
-            catalog_cols = ['Codigo', 'Producto', 'Categoria', 'Ubicacion']
-            catalog_cols_present = [col for col in catalog_cols if col in stock_df.columns]
-            if catalog_cols_present:
-                 st.dataframe(stock_df[catalog_cols_present].reset_index(drop=True), use_container_width=True, hide_index=True)
-            else:
-                st.info("Columnas básicas de catálogo ('Codigo', 'Producto', 'Categoria', 'Ubicacion') no encontradas.")
+    if tab_stock.open:
+        st.header("Gestión de Stock (Catálogo e Inventario)")
 
+        # Check if stock_df is a DataFrame and is loaded (can be empty but structured)
+        if isinstance(stock_df, pd.DataFrame): # Check if parsing was successful at all (returned a DF)
+            if not stock_df.empty: # Check if the DF has rows
 
-            st.markdown("---")
+                st.subheader("Catálogo de Items")
+                # Define columns to display for the basic catalog, filter by presence in DF
+                catalog_cols = ['Codigo', 'Producto', 'Categoria', 'Ubicacion']
+                catalog_cols_present = [col for col in catalog_cols if col in stock_df.columns]
+                if catalog_cols_present:
+                     # Arrow table kept in session state per stock file, not re-converted on every rerun
+                     catalog_table = get_session_derived('catalog_table', st.session_state.last_stock_file_id, build_display_table, stock_df, tuple(catalog_cols_present))
+                     st.dataframe(catalog_table, use_container_width=True, hide_index=True)
+                else:
+                    st.info("Columnas básicas de catálogo ('Codigo', 'Producto', 'Categoria', 'Ubicacion') no encontradas.")
 
-            # --- Stock Inventory Section ---
-            st.subheader("Inventario y Valores de Stock")
 
-            # Check if the DataFrame has the necessary columns for inventory value calculations and STOCK_MINIMO
-            # Use these checks to control what is displayed in this section
-            required_inventory_value_cols = ['CantidadActual', 'CostoUnitario', 'Valor Total Item'] # 'Valor Total Item' is calculated
-            has_all_required_value_cols = all(col in stock_df.columns for col in required_inventory_value_cols)
-            has_stock_min_col = 'STOCK_MINIMO' in stock_df.columns
+                st.markdown("---")
 
+                # --- Stock Inventory Section ---
+                st.subheader("Inventario y Valores de Stock")
 
-            if has_all_required_value_cols:
-                 st.info("Mostrando datos de inventario (Cantidad, Costo, Valor Total, Stock Mínimo si está presente) solo para ítems con Cantidad o Valor no cero.")
+                # Check if the DataFrame has the necessary columns for inventory value calculations and STOCK_MINIMO
+                # Use these checks to control what is displayed in this section
+                required_inventory_value_cols = ['CantidadActual', 'CostoUnitario', 'Valor Total Item'] # 'Valor Total Item' is calculated
+                has_all_required_value_cols = all(col in stock_df.columns for col in required_inventory_value_cols)
+                has_stock_min_col = 'STOCK_MINIMO' in stock_df.columns
 
-                 # Filter to show items where the calculated value or quantity is non-zero for display in inventory table
-                 inventory_display_df = stock_df[(abs(stock_df['CantidadActual']) > 1e-9) | (abs(stock_df['Valor Total Item']) > 1e-9)].copy()
 
-                 if not inventory_display_df.empty:
+                if has_all_required_value_cols:
+                     st.info("Mostrando datos de inventario (Cantidad, Costo, Valor Total, Stock Mínimo si está presente) solo para ítems con Cantidad o Valor no cero.")
+
                      # Define columns for the inventory table display, include STOCK_MINIMO if present
                      inventory_display_cols = ['Codigo', 'Producto', 'Categoria', 'CantidadActual']
                      if has_stock_min_col: inventory_display_cols.append('STOCK_MINIMO')
                      inventory_display_cols.extend(['CostoUnitario', 'Valor Total Item', 'Ubicacion'])
                      # Filter columns again to ensure they are present in the actual dataframe
-                     inventory_display_cols_present = [col for col in inventory_display_cols if col in inventory_display_df.columns]
-
-                     if inventory_display_cols_present:
-                          # --- Display Inventory Table with potential styling note ---
-                          # Styling for low stock is complex with st.dataframe. Provide info text instead.
-                          if has_stock_min_col and 'STOCK_MINIMO' in inventory_display_cols_present:
-                              if inventory_display_df['STOCK_MINIMO'].dropna().sum() > 1e-9:
-                                  st.warning("Las filas con Cantidad Actual por debajo del Stock Mínimo definido se deberían resaltar (funcionalidad de resaltado de tabla requiere implementación avanzada).")
+                     inventory_display_cols_present = [col for col in inventory_display_cols if col in stock_df.columns]
+
+                     # Items where the calculated value or quantity is non-zero, as a sorted Arrow table
+                     # kept in session state per stock file (filtered and converted once, not on every rerun)
+                     inventory_table = get_session_derived('inventory_table', st.session_state.last_stock_file_id, compute_inventory_table, stock_df, tuple(inventory_display_cols_present))
+
+                     if inventory_table.num_rows > 0:
+                         if inventory_display_cols_present:
+                              # --- Display Inventory Table with potential styling note ---
+                              # Styling for low stock is complex with st.dataframe. Provide info text instead.
+                              if has_stock_min_col and 'STOCK_MINIMO' in inventory_display_cols_present:
+                                  if np.nansum(inventory_table.column('STOCK_MINIMO').to_numpy()) > 1e-9: # Single reduction, no dropna copy
+                                      st.warning("Las filas con Cantidad Actual por debajo del Stock Mínimo definido se deberían resaltar (funcionalidad de resaltado de tabla requiere implementación avanzada).")
+                                  else:
+                                      st.info("La columna 'STOCK_MINIMO' fue encontrada, pero no se definieron valores positivos de stock mínimo.")
                               else:
-                                  st.info("La columna 'STOCK_MINIMO' fue encontrada, pero no se definieron valores positivos de stock mínimo.")
-                          else:
-                              st.info("La columna 'STOCK_MINIMO' no fue encontrada en el archivo, por lo que el análisis de stock mínimo no está disponible.")
-
-                          # Display DataFrame
-                          st.dataframe(
-                               inventory_display_df[inventory_display_cols_present].sort_values(by='Valor Total Item', ascending=False).reset_index(drop=True),
-                               use_container_width=True,
-                               hide_index=True
-                          )
+                                  st.info("La columna 'STOCK_MINIMO' no fue encontrada en el archivo, por lo que el análisis de stock mínimo no está disponible.")
+
+                              # Display DataFrame
+                              st.dataframe(
+                                   inventory_table,
+                                   use_container_width=True,
+                                   hide_index=True
+                              )
+
+                         else:
+                              st.warning("Columnas necesarias para mostrar el inventario detallado ('CantidadActual', 'CostoUnitario', 'Valor Total Item', etc.) faltantes después del procesamiento.")
+
+
+                         st.markdown("---")
+                         # --- Stock Value by Category (Pie Chart) ---
+                         st.subheader("Distribución del Valor Total de Stock por Categoría")
+
+                         # Check if required columns for this plot are present and data exists
+                         if 'Categoria' in stock_df.columns and 'Valor Total Item' in stock_df.columns:
+                              # Sum of Valor Total Item by category over stock_df (all items), kept in session state per stock file
+                              stock_value_by_category = get_session_derived('stock_value_by_category', st.session_state.last_stock_file_id, compute_stock_value_by_category, stock_df)
+
+                              # Filter out categories with zero total value for the chart, unless *all* categories have zero value and there's only one entry (like 'Sin Categoría' = 0)
+                              # Keep a single category with 0 if it's the only one to show a blank/zero chart explicitly
+                              if stock_value_by_category.shape[0] > 1 or (stock_value_by_category.shape[0] == 1 and abs(stock_value_by_category['Valor Total Item'].iloc[0]) > 1e-9): # Check absolute value
+                                  stock_value_by_category = stock_value_by_category[stock_value_by_category['Valor Total Item'].abs() > 1e-9] # Filter based on absolute value for robustness
+
+                              if not stock_value_by_category.empty:
+                                   # Already aggregated: build the trace directly from the arrays (no Plotly Express DataFrame layer)
+                                   fig_stock_value_by_category = go.Figure(go.Pie(
+                                       labels=stock_value_by_category['Categoria_Group'].to_numpy(dtype=object),
+                                       values=stock_value_by_category['Valor Total Item'].to_numpy(),
+                                       hole=0.4 # Make it a donut chart
+                                   ))
+                                   fig_stock_value_by_category.update_layout(title='Distribución del Valor Total de Stock por Categoría')
+                                   st.plotly_chart(fig_stock_value_by_category, use_container_width=True)
+                               # Else: no categories with non-zero value after filtering, or chart wouldn't make sense
+                              else:
+                                   st.info("No hay categorías con un valor total de stock significativo (distinto de cero).")
+
+                          # Display overall grand total stock value
+                         # Total over stock_df (all items), computed once when the file was parsed
+                         grand_total_stock_value = st.session_state.get('stock_total_value')
+                         if grand_total_stock_value is None:
+                             grand_total_stock_value = float(stock_df['Valor Total Item'].sum())
+                         if abs(grand_total_stock_value) > 1e-9:
+                             st.subheader(f"Valor Total Estimado del Inventario: ${grand_total_stock_value:,.2f}")
+                         elif inventory_table.num_rows > 0:
+                              # If some items have non-zero quantity/value individually but the grand total sums to zero (e.g., pos/neg items)
+                              st.info("El valor total calculado del inventario suma a cero o es insignificante.")
+                         else:
+                              st.info("No hay ítems en el inventario con cantidad o valor no cero.")
 
                      else:
-                          st.warning("Columnas necesarias para mostrar el inventario detallado ('CantidadActual', 'CostoUnitario', 'Valor Total Item', etc.) faltantes después del procesamiento.")
-
-
-                     st.markdown("---")
-                     # --- Stock Value by Category (Pie Chart) ---
-                     st.subheader("Distribución del Valor Total de Stock por Categoría")
-
-                     # Check if required columns for this plot are present and data exists
-                     if 'Categoria' in stock_df.columns and 'Valor Total Item' in stock_df.columns:
-                          stock_df_for_chart = stock_df.copy() # Use stock_df (with all items) for category total calculation
-                          # Grouping by category, ensure category is a clean string and handle NaNs/empty
-                          stock_df_for_chart['Categoria_Group'] = stock_df_for_chart['Categoria'].astype(str).str.strip().fillna('Sin Categoría')
-
-                          # Calculate sum of Valor Total Item by Category Group
-                          stock_value_by_category = stock_df_for_chart.groupby('Categoria_Group')['Valor Total Item'].sum().reset_index()
-
-                          # Filter out categories with zero total value for the chart, unless *all* categories have zero value and there's only one entry (like 'Sin Categoría' = 0)
-                          # Keep a single category with 0 if it's the only one to show a blank/zero chart explicitly
-                          if stock_value_by_category.shape[0] > 1 or (stock_value_by_category.shape[0] == 1 and abs(stock_value_by_category['Valor Total Item'].iloc[0]) > 1e-9): # Check absolute value
-                              stock_value_by_category = stock_value_by_category[stock_value_by_category['Valor Total Item'].abs() > 1e-9] # Filter based on absolute value for robustness
-
-                          if not stock_value_by_category.empty:
-                               fig_stock_value_by_category = px.pie(
-                                   stock_value_by_category,
-                                   values='Valor Total Item',
-                                   names='Categoria_Group',
-                                   title='Distribución del Valor Total de Stock por Categoría',
-                                   hole=0.4 # Make it a donut chart
-                               )
-                               st.plotly_chart(fig_stock_value_by_category, use_container_width=True)
-                           # Else: no categories with non-zero value after filtering, or chart wouldn't make sense
-                          else:
-                               st.info("No hay categorías con un valor total de stock significativo (distinto de cero).")
-
-                      # Display overall grand total stock value
-                     grand_total_stock_value = stock_df['Valor Total Item'].sum() # Use stock_df (all items) for total value sum
-                     if abs(grand_total_stock_value) > 1e-9:
-                         st.subheader(f"Valor Total Estimado del Inventario: ${grand_total_stock_value:,.2f}")
-                     elif not inventory_display_df.empty:
-                          # If some items have non-zero quantity/value individually but the grand total sums to zero (e.g., pos/neg items)
-                          st.info("El valor total calculado del inventario suma a cero o es insignificante.")
-                     else:
-                          st.info("No hay ítems en el inventario con cantidad o valor no cero.")
+                          st.info("El archivo de Stock cargado contiene columnas de inventario, pero todas las filas tienen Cantidad Actual y/o Costo Unitario en cero o valores insignificantes.")
+                          st.write("Asegúrate de que los valores en 'CantidadActual', 'CostoUnitario' y 'STOCK_MINIMO' sean numéricos y no estén en cero en las filas de datos relevantes para que aparezcan en el inventario.")
 
-                 else:
-                      st.info("El archivo de Stock cargado contiene columnas de inventario, pero todas las filas tienen Cantidad Actual y/o Costo Unitario en cero o valores insignificantes.")
-                      st.write("Asegúrate de que los valores en 'CantidadActual', 'CostoUnitario' y 'STOCK_MINIMO' sean numéricos y no estén en cero en las filas de datos relevantes para que aparezcan en el inventario.")
 
+                else: # Inventory calculation columns ('CantidadActual', 'CostoUnitario') missing after parsing
+                    st.info("El archivo de Stock cargado solo contiene el catálogo básico de ítems. Faltan las columnas 'CantidadActual' o 'CostoUnitario' necesarias para calcular y mostrar el valor del inventario.")
 
-            else: # Inventory calculation columns ('CantidadActual', 'CostoUnitario') missing after parsing
-                st.info("El archivo de Stock cargado solo contiene el catálogo básico de ítems. Faltan las columnas 'CantidadActual' o 'CostoUnitario' necesarias para calcular y mostrar el valor del inventario.")
 
+                st.markdown("---")
+                # --- Missing Functionality Message ---
+                st.subheader("Sugerencias para una Gestión de Stock Adicional")
+                st.warning("Para una gestión de stock más completa se necesitan:")
+                st.markdown("""
+                    - **Registro de Movimientos:** Un archivo o sistema separado para registrar entradas y salidas con fecha, tipo de movimiento ('Entrada', 'Salida', 'Ajuste'), motivo (compra, consumo, venta, merma, ajuste) y el equipo/proyecto/ubicación asociado a la salida.
+                    - **Reportes de Movimiento:** Tablas y gráficos del historial de uso/consumo/entrada de ítems, filtrable por fecha, ítem, equipo, etc.
+                    - **Evolución del Stock:** Gráficos que muestren cambios en la cantidad/valor de ítems críticos a lo largo del tiempo (requiere datos históricos de stock o registros de movimiento).
+                """)
 
-            st.markdown("---")
-            # --- Missing Functionality Message ---
-            st.subheader("Sugerencias para una Gestión de Stock Adicional")
-            st.warning("Para una gestión de stock más completa se necesitan:")
-            st.markdown("""
-                - **Registro de Movimientos:** Un archivo o sistema separado para registrar entradas y salidas con fecha, tipo de movimiento ('Entrada', 'Salida', 'Ajuste'), motivo (compra, consumo, venta, merma, ajuste) y el equipo/proyecto/ubicación asociado a la salida.
-                - **Reportes de Movimiento:** Tablas y gráficos del historial de uso/consumo/entrada de ítems, filtrable por fecha, ítem, equipo, etc.
-                - **Evolución del Stock:** Gráficos que muestren cambios en la cantidad/valor de ítems críticos a lo largo del tiempo (requiere datos históricos de stock o registros de movimiento).
-            """)
 
+            # --- Handle case where Stock file was loaded but is empty after processing ---
+            elif stock_df.empty:
+                 st.info("El archivo de Stock fue procesado, pero no contiene ninguna fila de datos válida (además de la cabecera).")
+                 st.warning("Asegúrate de que el archivo `stock_simple.csv` tenga filas debajo de la cabecera principal que no estén vacías o mal formadas, y que incluyan al menos un `Codigo` y una `Categoria` válidos.")
 
-        # --- Handle case where Stock file was loaded but is empty after processing ---
-        elif stock_df.empty:
-             st.info("El archivo de Stock fue procesado, pero no contiene ninguna fila de datos válida (además de la cabecera).")
-             st.warning("Asegúrate de que el archivo `stock_simple.csv` tenga filas debajo de la cabecera principal que no estén vacías o mal formadas, y que incluyan al menos un `Codigo` y una `Categoria` válidos.")
-
-    # --- Handle case where Stock file was NOT loaded or parsing failed critically ---
-    else: # stock_df is None (shouldn't happen with the new retrieval logic, but safety)
-        st.info("Por favor, carga el archivo `stock_simple.csv` para ver el catálogo y gestión de stock.")
-
-
-    # --- Stock de Combustible Section ---
-    st.markdown("---")
-    st.subheader("Stock de Combustible (Cantidades en Litros)")
-
-    # Check if fuel data was loaded at all (either DF is structured or initial stock dict is present)
-    # fuel_df is guaranteed to be a DataFrame (potentially empty but structured) or None on critical error
-    # fuel_initial_stock is guaranteed to be a dict (potentially zeroed) or None on critical error
-    has_fuel_data_available = (isinstance(fuel_df, pd.DataFrame)) or (isinstance(fuel_initial_stock, dict))
-
-    if has_fuel_data_available:
-        # Get initial stock values, defaulting to 0.0 if fuel_initial_stock is None or key is missing
-        initial_gasoil = fuel_initial_stock.get('GASOIL', 0.0) if isinstance(fuel_initial_stock, dict) else 0.0
-        initial_nafta = fuel_initial_stock.get('NAFTA', 0.0) if isinstance(fuel_initial_stock, dict) else 0.0
-
-        total_ingress_gasoil = 0.0
-        total_egress_gasoil = 0.0
-        total_ingress_nafta = 0.0
-        total_egress_nafta = 0.0
-
-        # Check if fuel_df is usable for calculations (is DataFrame, not empty, has essential columns)
-        required_fuel_sum_cols = ['Tipo de Comb.', 'Lts Ingreso', 'Lts Egreso']
-        if isinstance(fuel_df, pd.DataFrame) and not fuel_df.empty and all(col in fuel_df.columns for col in required_fuel_sum_cols):
-             # Filter data by fuel type
-             df_gasoil = fuel_df[fuel_df['Tipo de Comb.'] == 'GASOIL'].copy() # Use .copy()
-             df_nafta = fuel_df[fuel_df['Tipo de Comb.'] == 'NAFTA'].copy()   # Use .copy()
-
-             # Calculate sums. Use .sum() which correctly handles empty DFs or columns (results in 0.0).
-             total_ingress_gasoil = df_gasoil['Lts Ingreso'].sum() if 'Lts Ingreso' in df_gasoil.columns else 0.0
-             total_egress_gasoil = df_gasoil['Lts Egreso'].sum() if 'Lts Egreso' in df_gasoil.columns else 0.0
-             total_ingress_nafta = df_nafta['Lts Ingreso'].sum() if 'Lts Ingreso' in df_nafta.columns else 0.0
-             total_egress_nafta = df_nafta['Lts Egreso'].sum() if 'Lts Egreso' in df_nafta.columns else 0.0
-        elif isinstance(fuel_df, pd.DataFrame) and (fuel_df.empty or not all(col in fuel_df.columns for col in required_fuel_sum_cols)):
-             # fuel_df is a DataFrame but is empty or missing columns required for sum.
-             missing_sum_cols = [col for col in required_fuel_sum_cols if col not in fuel_df.columns]
-             if missing_sum_cols:
-                 st.warning(f"Stock Combustible: Faltan columnas ({', '.join(missing_sum_cols)}) en el DataFrame de combustible procesado para calcular totales de ingresos/egresos.")
-             else:
-                 st.info("Stock Combustible: El archivo de Combustible no contiene registros de movimientos de datos válidos.")
+        # --- Handle case where Stock file was NOT loaded or parsing failed critically ---
+        else: # stock_df is None (shouldn't happen with the new retrieval logic, but safety)
+            st.info("Por favor, carga el archivo `stock_simple.csv` para ver el catálogo y gestión de stock.")
 
 
-        # Calculate estimated current stock based on initial balance + ingress - egress
-        current_stock_gasoil = initial_gasoil + total_ingress_gasoil - total_egress_gasoil
-        current_stock_nafta = initial_nafta + total_ingress_nafta - total_egress_nafta
+        # --- Stock de Combustible Section ---
+        st.markdown("---")
+        st.subheader("Stock de Combustible (Cantidades en Litros)")
+
+        # Check if fuel data was loaded at all (either DF is structured or initial stock dict is present).
+        # This is the only state the section branches on: an empty fuel_df (no DATA rows) is handled inside,
+        # with the movements message and the SETUP balances, so there is no separate empty/setup-only branch.
+        # fuel_df is guaranteed to be a DataFrame (potentially empty but structured) or None on critical error
+        # fuel_initial_stock is guaranteed to be a dict (potentially zeroed) or None on critical error
+        has_fuel_data_available = (isinstance(fuel_df, pd.DataFrame)) or (isinstance(fuel_initial_stock, dict))
+
+        if has_fuel_data_available:
+            # Get initial stock values once, defaulting to 0.0 if fuel_initial_stock is None or key is missing
+            initial_gasoil = fuel_initial_stock.get('GASOIL', 0.0) if isinstance(fuel_initial_stock, dict) else 0.0
+            initial_nafta = fuel_initial_stock.get('NAFTA', 0.0) if isinstance(fuel_initial_stock, dict) else 0.0
+
+            totals_by_fuel_type = {}
+
+            # Check if fuel_df is usable for calculations (is DataFrame, not empty, has essential columns)
+            required_fuel_sum_cols = ['Tipo de Comb.', 'Lts Ingreso', 'Lts Egreso']
+            # Missing required columns computed once (ordered as required_fuel_sum_cols) and reused by both branches
+            fuel_columns_present = set(fuel_df.columns) if isinstance(fuel_df, pd.DataFrame) else set()
+            missing_sum_cols = [col for col in required_fuel_sum_cols if col not in fuel_columns_present]
+            if isinstance(fuel_df, pd.DataFrame) and not fuel_df.empty and not missing_sum_cols:
+                 # A fuel type without rows is simply absent from the result and keeps its 0.0 total
+                 totals_by_fuel_type = get_session_derived('fuel_type_totals', st.session_state.last_fuel_file_id, compute_fuel_type_totals, fuel_df)
+            elif isinstance(fuel_df, pd.DataFrame):
+                 # fuel_df is a DataFrame but is empty or missing columns required for sum.
+                 if missing_sum_cols:
+                     st.warning(f"Stock Combustible: Faltan columnas ({', '.join(missing_sum_cols)}) en el DataFrame de combustible procesado para calcular totales de ingresos/egresos.")
+                 else:
+                     st.info("Stock Combustible: El archivo de Combustible no contiene registros de movimientos de datos válidos.")
 
+            # Balances and display flag per fuel type computed up front; rendering is one loop over the result
+            fuel_stock_summary = build_fuel_stock_summary(totals_by_fuel_type, {'GASOIL': initial_gasoil, 'NAFTA': initial_nafta})
+            displayed_fuel_types = [fuel_type for fuel_type in FUEL_STOCK_TYPES if fuel_stock_summary[fuel_type]['has_data']]
 
-        # Determine if we have *any* data to display for Gasoil or Nafta stock breakdown
-        has_gasoil_data_to_display = abs(initial_gasoil) > 1e-9 or abs(total_ingress_gasoil) > 1e-9 or abs(total_egress_gasoil) > 1e-9 or abs(current_stock_gasoil) > 1e-9
-        has_nafta_data_to_display = abs(initial_nafta) > 1e-9 or abs(total_ingress_nafta) > 1e-9 or abs(total_egress_nafta) > 1e-9 or abs(current_stock_nafta) > 1e-9
+            for position, fuel_type in enumerate(displayed_fuel_types):
+                if position: st.markdown("---") # Add separator only if displaying both types
+                fuel_stock = fuel_stock_summary[fuel_type]
+                st.write(f"- Saldo Inicial {fuel_type} (línea SETUP): {fuel_stock['initial']:,.2f} Lts")
+                st.write(f"- Ingreso Total {fuel_type} (registrado en DATA): {fuel_stock['ingress']:,.2f} Lts")
+                st.write(f"- Egreso Total {fuel_type} (registrado en DATA): {fuel_stock['egress']:,.2f} Lts")
+                st.write(f"**Saldo Actual Estimado {fuel_type}: {fuel_stock['current']:,.2f} Lts**")
 
 
-        if has_gasoil_data_to_display:
-            st.write(f"- Saldo Inicial GASOIL (línea SETUP): {initial_gasoil:,.2f} Lts")
-            st.write(f"- Ingreso Total GASOIL (registrado en DATA): {total_ingress_gasoil:,.2f} Lts")
-            st.write(f"- Egreso Total GASOIL (registrado en DATA): {total_egress_gasoil:,.2f} Lts")
-            st.write(f"**Saldo Actual Estimado GASOIL: {current_stock_gasoil:,.2f} Lts**")
-            if has_nafta_data_to_display: st.markdown("---") # Add separator only if displaying both types
+            if not displayed_fuel_types:
+                 st.info("No se encontraron datos de ingresos/egresos no cero ni saldos iniciales no cero para combustible.")
 
-        if has_nafta_data_to_display:
-            st.write(f"- Saldo Inicial NAFTA (línea SETUP): {initial_nafta:,.2f} Lts")
-            st.write(f"- Ingreso Total NAFTA (registrado en DATA): {total_ingress_nafta:,.2f} Lts")
-            st.write(f"- Egreso Total NAFTA (registrado en DATA): {total_egress_nafta:,.2f} Lts")
-            st.write(f"**Saldo Actual Estimado NAFTA: {current_stock_nafta:,.2f} Lts**")
 
+            st.warning("Este cálculo de stock de combustible es una estimación basada en los saldos iniciales SETUP y los ingresos/egresos registrados en las filas de datos. Las filas de egreso marcadas como 'PRESTAMO' en los comentarios NO se excluyen automáticamente de los egresos totales en este cálculo simple.")
 
-        if not has_gasoil_data_to_display and not has_nafta_data_to_display:
-             st.info("No se encontraron datos de ingresos/egresos no cero ni saldos iniciales no cero para combustible.")
+            st.markdown("---")
+            st.subheader("Sugerencias para Mejorar la Gestión de Stock de Combustible")
+            st.markdown("""
+                - Asegúrate de que las líneas `SETUP` para saldos iniciales y mapeos de código estén correctas y que los campos numéricos tengan valores válidos.
+                - Considera usar una columna `TipoMovimiento` ('Consumo', 'Prestamo', 'Devolucion', 'Ajuste Entrada', 'Ajuste Salida') en las filas de datos para una gestión más clara y controlable. Si marcas un egreso como 'Prestamo', podrías querer excluirlo del cálculo de 'Egreso Total'.
+                - Un registro periódico de saldo a fecha (`DATA, FechadeConteo, SaldoObservado,...`) ayudaría a auditar y ajustar el saldo calculado con el saldo real.
+                - Graficar la evolución del saldo de combustible a lo largo del tiempo sería útil (requiere los movimientos con fecha o saldos periódicos).
+            """)
 
+        # Handle case where Fuel file was NOT loaded or parsing failed critically (fuel_df is None)
+        else: # fuel_df is None (shouldn't happen with the new retrieval logic, but safety)
+            st.info("Por favor, carga el archivo `combustible_simple_v2.csv` para ver el stock de combustible y su gestión.")
 
-        st.warning("Este cálculo de stock de combustible es una estimación basada en los saldos iniciales SETUP y los ingresos/egresos registrados en las filas de datos. Las filas de egreso marcadas como 'PRESTAMO' en los comentarios NO se excluyen automáticamente de los egresos totales en este cálculo simple.")
 
-        st.markdown("---")
-        st.subheader("Sugerencias para Mejorar la Gestión de Stock de Combustible")
+# --- TAB: Creación de Presupuestos ---
+with tab_budget:
+    if tab_budget.open:
+        st.header("Funcionalidad Sugerida: Creación de Presupuestos / Cotizaciones")
+
+        st.info("El propósito de la aplicación actual es principalmente analizar archivos CSV existentes (Stock, Presupuesto simple, Combustible). **Esta sección no implementa la creación dinámica de nuevos presupuestos.** ")
+        st.warning("Desarrollar una funcionalidad completa para crear presupuestos/cotizaciones seleccionando elementos (servicios, equipos, materiales de stock) requeriría la implementación de lógica de precios compleja y bases de datos maestras.")
+
+        st.subheader("Información Necesaria Típicamente para Crear Presupuestos Dinámicos")
         st.markdown("""
-            - Asegúrate de que las líneas `SETUP` para saldos iniciales y mapeos de código estén correctas y que los campos numéricos tengan valores válidos.
-            - Considera usar una columna `TipoMovimiento` ('Consumo', 'Prestamo', 'Devolucion', 'Ajuste Entrada', 'Ajuste Salida') en las filas de datos para una gestión más clara y controlable. Si marcas un egreso como 'Prestamo', podrías querer excluirlo del cálculo de 'Egreso Total'.
-            - Un registro periódico de saldo a fecha (`DATA, FechadeConteo, SaldoObservado,...`) ayudaría a auditar y ajustar el saldo calculado con el saldo real.
-            - Graficar la evolución del saldo de combustible a lo largo del tiempo sería útil (requiere los movimientos con fecha o saldos periódicos).
+            Para crear presupuestos y cotizaciones seleccionando servicios, equipos y materiales de forma dinámica, generalmente se necesitan bases de datos maestras detalladas, como:
+            - **Maestro de Servicios/Productos para Venta:** Listado de ítems o servicios que se cotizan al cliente, su descripción detallada y, crucialmente, el **precio unitario de cotización (precio de venta)**.
+            - **Maestro de Costos de Recursos:** Listados separados con los costos unitarios internos de diferentes tipos de recursos, como:
+                - Tarifas horarias o diarias de **Mano de Obra** (por categoría/especialidad).
+                - Costos horarios o por kilómetro/uso de **Equipos Propios**.
+                - Costos unitarios de **Materiales de Stock** (esto lo podrías obtener de tu archivo de stock cargado si tiene el campo `CostoUnitario`).
+                - Costos de Subcontratistas, Permisos, etc.
+            - **Estructura/Reglas de Costos/Precio:** Lógica para calcular automáticamente o ingresar manualmente otros costos no directos (costos indirectos, gastos generales, gastos de venta) y la **Utilidad** deseada. Finalmente, considerar Impuestos (IVA, etc.).
+
+            En la estructura simple de presupuesto que se carga (presupuesto_simple.csv), solo defines totales agrupados por unas pocas categorías (`Movilizacion`, `Costos Directos`, etc.), que son útiles para el análisis a alto nivel o gráficos de cascada, pero no contienen el detalle granular necesario para armar una cotización ítem por ítem.
         """)
 
-    # Handle cases where Fuel file was processed but has specific emptiness states
-    # Check if fuel_df is a DataFrame before checking its emptiness
-    elif isinstance(fuel_df, pd.DataFrame) and fuel_df.empty and isinstance(fuel_initial_stock, dict) and (abs(fuel_initial_stock.get('GASOIL', 0.0)) > 1e-9 or abs(fuel_initial_stock.get('NAFTA', 0.0)) > 1e-9):
-         st.info(f"El archivo de Combustible fue procesado. Se encontraron saldos iniciales en las líneas SETUP, pero no registros de movimientos (ingresos/egresos) válidos en las filas DATA.")
-         st.write(f"Saldo Inicial GASOIL: {fuel_initial_stock.get('GASOIL', 0.0):,.2f} Lts")
-         st.write(f"Saldo Inicial NAFTA: {fuel_initial_stock.get('NAFTA', 0.0):,.2f} Lts")
-         st.warning("Asegúrate de que haya filas debajo de la cabecera principal ('Fecha,Equipo,...') que contengan valores válidos en 'LtsIngreso'/'LtsEgreso' y demás columnas.")
+        # --- Display Example Structure based on loaded files ---
+        # Check if eco_data is a dictionary before trying to access keys
+        if eco_has_seasons:
+             st.subheader("Estructura de Costos de Ejemplo (obtenida del archivo `presupuesto_simple.csv`):")
+             st.write("Esta estructura muestra los totales agrupados por las categorías principales:")
+             col1, col2 = st.columns(2)
+             with col1:
+                  st.markdown("##### Invierno")
+                  # Iterate over keys present in the dict, using the ordered list for preference
+                  # One table per group instead of one st.write per category
+                  if eco_present_keys_inv:
+                       st.table(build_cost_table(eco_costs_inv, eco_present_keys_inv, 'Invierno'))
+                  # Handle any extra keys that might have been parsed but aren't in the ordered list
+                  if eco_extra_keys_inv:
+                       st.markdown("###### Otras Categorías (Invierno):")
+                       st.table(build_cost_table(eco_costs_inv, eco_extra_keys_inv, 'Invierno'))
+
+
+             with col2:
+                  st.markdown("##### Verano")
+                  # Iterate over keys present in the dict, using the ordered list for preference
+                  # One table per group instead of one st.write per category
+                  if eco_present_keys_verano:
+                       st.table(build_cost_table(eco_costs_verano, eco_present_keys_verano, 'Verano'))
+                  # Handle any extra keys that might have been parsed but aren't in the ordered list
+                  if eco_extra_keys_verano:
+                       st.markdown("###### Otras Categorías (Verano):")
+                       st.table(build_cost_table(eco_costs_verano, eco_extra_keys_verano, 'Verano'))
+
+
+        # Check if eco_data is a dictionary but appears empty (no 'invierno' or 'verano' keys with data)
+        elif not eco_has_seasons:
+             st.info("Archivo de Presupuesto cargado, pero no se extrajeron datos de costos con las estructuras de 'invierno'/'verano' esperadas.")
+        # This condition should now cover the case where eco_data is the zeroed structure returned by the parser
+        elif eco_has_both_seasons and np.abs(eco_main_values).max() < 1e-9:
+             st.info("Archivo de Presupuesto cargado, pero los costos para las categorías principales son cero o insignificantes en ambas temporadas.")
+
+        # Message when no eco file is loaded or parsing failed critically (eco_data is the default structured dict with zeros)
+        else: # eco_data is the default zeroed structure, indicating no file loaded or critical parse error
+            st.info("Carga el archivo `presupuesto_simple.csv` para ver la estructura de costos de ejemplo leída.")
+
+
+        if isinstance(stock_df, pd.DataFrame) and not stock_df.empty:
+             st.subheader("Primeros Ítems del Catálogo de Stock (obtenidos del archivo `stock_simple.csv`):")
+             # Preview columns, CostoUnitario check and first rows computed once per stock file
+             display_cols_stock_example_present, has_costo_unitario_col_in_df, stock_preview_df = get_session_derived('stock_preview', st.session_state.last_stock_file_id, compute_stock_preview, stock_df)
+
+             if display_cols_stock_example_present:
+                  if has_costo_unitario_col_in_df:
+                       st.write("Este catálogo (si tiene la columna `CostoUnitario` completa) podría servir como un **maestro de materiales** para presupuestar costos:")
+                  else:
+                       st.write("Este catálogo básico es útil para referencia, pero **le falta la columna `CostoUnitario` con valores numéricos** para ser usado directamente en la creación de presupuestos que calculen costos de materiales.")
 
-    elif isinstance(fuel_df, pd.DataFrame) and fuel_df.empty and isinstance(fuel_initial_stock, dict) and not (abs(fuel_initial_stock.get('GASOIL', 0.0)) > 1e-9 or abs(fuel_initial_stock.get('NAFTA', 0.0)) > 1e-9):
-         st.info("El archivo de Combustible fue procesado. No se encontraron registros de movimientos válidos (DATA) ni saldos iniciales no cero (SETUP).")
+                  # Display first few rows of the stock data
+                  st.dataframe(stock_preview_df, use_container_width=True, hide_index=True)
+             else:
+                  st.info("El archivo de Stock cargado no contiene columnas básicas ('Codigo', 'Producto', 'Categoria') para mostrar un catálogo de ejemplo.")
 
-    # Handle case where Fuel file was NOT loaded or parsing failed critically (fuel_df is None)
-    else: # fuel_df is None (shouldn't happen with the new retrieval logic, but safety)
-        st.info("Por favor, carga el archivo `combustible_simple_v2.csv` para ver el stock de combustible y su gestión.")
+        elif isinstance(stock_df, pd.DataFrame) and stock_df.empty:
+            st.info("Archivo de Stock cargado y procesado, pero está vacío.")
 
+        # Message when no stock file is loaded or parsing failed critically (stock_df is the default structured DF)
+        else: # stock_df is the default structured DF, indicating no file loaded or critical parse error
+            st.info("Carga el archivo `stock_simple.csv` para ver un catálogo de ítems de ejemplo (potencial maestro de materiales).")
 
-# --- TAB: Creación de Presupuestos ---
-with tab_budget:
-    st.header("Funcionalidad Sugerida: Creación de Presupuestos / Cotizaciones")
-
-    st.info("El propósito de la aplicación actual es principalmente analizar archivos CSV existentes (Stock, Presupuesto simple, Combustible). **Esta sección no implementa la creación dinámica de nuevos presupuestos.** ")
-    st.warning("Desarrollar una funcionalidad completa para crear presupuestos/cotizaciones seleccionando elementos (servicios, equipos, materiales de stock) requeriría la implementación de lógica de precios compleja y bases de datos maestras.")
-
-    st.subheader("Información Necesaria Típicamente para Crear Presupuestos Dinámicos")
-    st.markdown("""
-        Para crear presupuestos y cotizaciones seleccionando servicios, equipos y materiales de forma dinámica, generalmente se necesitan bases de datos maestras detalladas, como:
-        - **Maestro de Servicios/Productos para Venta:** Listado de ítems o servicios que se cotizan al cliente, su descripción detallada y, crucialmente, el **precio unitario de cotización (precio de venta)**.
-        - **Maestro de Costos de Recursos:** Listados separados con los costos unitarios internos de diferentes tipos de recursos, como:
-            - Tarifas horarias o diarias de **Mano de Obra** (por categoría/especialidad).
-            - Costos horarios o por kilómetro/uso de **Equipos Propios**.
-            - Costos unitarios de **Materiales de Stock** (esto lo podrías obtener de tu archivo de stock cargado si tiene el campo `CostoUnitario`).
-            - Costos de Subcontratistas, Permisos, etc.
-        - **Estructura/Reglas de Costos/Precio:** Lógica para calcular automáticamente o ingresar manualmente otros costos no directos (costos indirectos, gastos generales, gastos de venta) y la **Utilidad** deseada. Finalmente, considerar Impuestos (IVA, etc.).
-
-        En la estructura simple de presupuesto que se carga (presupuesto_simple.csv), solo defines totales agrupados por unas pocas categorías (`Movilizacion`, `Costos Directos`, etc.), que son útiles para el análisis a alto nivel o gráficos de cascada, pero no contienen el detalle granular necesario para armar una cotización ítem por ítem.
-    """)
-
-    # --- Display Example Structure based on loaded files ---
-    # Check if eco_data is a dictionary before trying to access keys
-    if isinstance(eco_data, dict) and (eco_data.get('invierno') is not None or eco_data.get('verano') is not None):
-         st.subheader("Estructura de Costos de Ejemplo (obtenida del archivo `presupuesto_simple.csv`):")
-         st.write("Esta estructura muestra los totales agrupados por las categorías principales:")
-         col1, col2 = st.columns(2)
-         with col1:
-              st.markdown("##### Invierno")
-              # Iterate over keys present in the dict, using the ordered list for preference
-              for key in [k for k in ordered_categories_internal_keys if k in eco_data.get('invierno', {})]:
-                   value = eco_data.get('invierno', {}).get(key, 0.0)
-                   st.write(f"- **{key}**: ${value:,.2f}")
-              # Handle any extra keys that might have been parsed but aren't in the ordered list
-              extra_inv_keys = [k for k in eco_data.get('invierno', {}).keys() if k not in ordered_categories_internal_keys]
-              if extra_inv_keys:
-                   st.markdown("###### Otras Categorías (Invierno):")
-                   for key in extra_inv_keys:
-                        value = eco_data.get('invierno', {}).get(key, 0.0)
-                        st.write(f"- **{key}**: ${value:,.2f}")
-
-
-         with col2:
-              st.markdown("##### Verano")
-              # Iterate over keys present in the dict, using the ordered list for preference
-              for key in [k for k in ordered_categories_internal_keys if k in eco_data.get('verano', {})]:
-                   value = eco_data.get('verano', {}).get(key, 0.0)
-                   st.write(f"- **{key}**: ${value:,.2f}")
-               # Handle any extra keys that might have been parsed but aren't in the ordered list
-              extra_verano_keys = [k for k in eco_data.get('verano', {}).keys() if k not in ordered_categories_internal_keys]
-              if extra_verano_keys:
-                   st.markdown("###### Otras Categorías (Verano):")
-                   for key in extra_verano_keys:
-                        value = eco_data.get('verano', {}).get(key, 0.0)
-                        st.write(f"- **{key}**: ${value:,.2f}")
-
-
-    # Check if eco_data is a dictionary but appears empty (no 'invierno' or 'verano' keys with data)
-    elif isinstance(eco_data, dict) and (eco_data.get('invierno') is None and eco_data.get('verano') is None):
-         st.info("Archivo de Presupuesto cargado, pero no se extrajeron datos de costos con las estructuras de 'invierno'/'verano' esperadas.")
-    # This condition should now cover the case where eco_data is the zeroed structure returned by the parser
-    elif isinstance(eco_data, dict) and (eco_data.get('invierno') is not None and eco_data.get('verano') is not None) and all(abs(eco_data.get('invierno', {}).get(k, 0.0)) < 1e-9 for k in ordered_categories_internal_keys) and all(abs(eco_data.get('verano', {}).get(k, 0.0)) < 1e-9 for k in ordered_categories_internal_keys):
-         st.info("Archivo de Presupuesto cargado, pero los costos para las categorías principales son cero o insignificantes en ambas temporadas.")
-
-    # Message when no eco file is loaded or parsing failed critically (eco_data is the default structured dict with zeros)
-    else: # eco_data is the default zeroed structure, indicating no file loaded or critical parse error
-        st.info("Carga el archivo `presupuesto_simple.csv` para ver la estructura de costos de ejemplo leída.")
-
-
-    if isinstance(stock_df, pd.DataFrame) and not stock_df.empty:
-         st.subheader("Primeros Ítems del Catálogo de Stock (obtenidos del archivo `stock_simple.csv`):")
-         # Check if the stock file included CostoUnitario (which is key for material costs in a budget)
-         has_costo_unitario_col_in_df = 'CostoUnitario' in stock_df.columns and not stock_df['CostoUnitario'].replace([0.0], np.nan).isnull().all() # Check column exists and has at least one non-zero, non-null value
-
-         # Define display columns for the stock example
-         display_cols_stock_example = ['Codigo', 'Producto', 'Categoria', 'CantidadActual'] # Base columns
-         if 'CostoUnitario' in stock_df.columns: display_cols_stock_example.append('CostoUnitario') # Add costo unitario if present
-         if 'Ubicacion' in stock_df.columns: display_cols_stock_example.append('Ubicacion') # Add ubicacion if present
-
-         display_cols_stock_example_present = [col for col in display_cols_stock_example if col in stock_df.columns] # Filter by actual presence
-
-         if display_cols_stock_example_present:
-              if has_costo_unitario_col_in_df:
-                   st.write("Este catálogo (si tiene la columna `CostoUnitario` completa) podría servir como un **maestro de materiales** para presupuestar costos:")
-              else:
-                   st.write("Este catálogo básico es útil para referencia, pero **le falta la columna `CostoUnitario` con valores numéricos** para ser usado directamente en la creación de presupuestos que calculen costos de materiales.")
-
-              # Display first few rows of the stock data
-              st.dataframe(stock_df[display_cols_stock_example_present].head(10).reset_index(drop=True), use_container_width=True, hide_index=True)
-         else:
-              st.info("El archivo de Stock cargado no contiene columnas básicas ('Codigo', 'Producto', 'Categoria') para mostrar un catálogo de ejemplo.")
-
-    elif isinstance(stock_df, pd.DataFrame) and stock_df.empty:
-        st.info("Archivo de Stock cargado y procesado, pero está vacío.")
-
-    # Message when no stock file is loaded or parsing failed critically (stock_df is the default structured DF)
-    else: # stock_df is the default structured DF, indicating no file loaded or critical parse error
-        st.info("Carga el archivo `stock_simple.csv` para ver un catálogo de ítems de ejemplo (potencial maestro de materiales).")
-
-    st.markdown("---")
-    st.subheader("Desarrollo de Funcionalidad Futura Sugerida:")
-    st.markdown("""
-        - Implementar una sección de "Nuevo Presupuesto" donde se puedan:
-            - Ingresar detalles generales (Nombre, Cliente, Fecha).
-            - Añadir ítems seleccionándolos de los "Maestros" (que cargarías o definirías): Servicios, Equipos, Materiales de Stock.
-            - Para cada ítem seleccionado, especificar cantidad, unidades, y si es necesario, ajustar el costo/precio unitario para esta cotización particular.
-            - Calcular totales: Subtotal por categorías, Costo Total Directo, Costo Total Indirecto, Utilidad, Precio Total de Venta.
-        - Requeriría definir cómo se calculan los costos indirectos y la utilidad (ej: porcentaje sobre costos directos, monto fijo, etc.).
-        - Generar un resumen o un reporte de presupuesto básico.
-    """)
+        st.markdown("---")
+        st.subheader("Desarrollo de Funcionalidad Futura Sugerida:")
+        st.markdown("""
+            - Implementar una sección de "Nuevo Presupuesto" donde se puedan:
+                - Ingresar detalles generales (Nombre, Cliente, Fecha).
+                - Añadir ítems seleccionándolos de los "Maestros" (que cargarías o definirías): Servicios, Equipos, Materiales de Stock.
+                - Para cada ítem seleccionado, especificar cantidad, unidades, y si es necesario, ajustar el costo/precio unitario para esta cotización particular.
+                - Calcular totales: Subtotal por categorías, Costo Total Directo, Costo Total Indirecto, Utilidad, Precio Total de Venta.
+            - Requeriría definir cómo se calculan los costos indirectos y la utilidad (ej: porcentaje sobre costos directos, monto fijo, etc.).
+            - Generar un resumen o un reporte de presupuesto básico.
+        """)
 
 
 # --- Instructions for File Modification in Sidebar ---
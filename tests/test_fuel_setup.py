@@ -0,0 +1,70 @@
+import csv
+import io
+import os
+import runpy
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app_2visma.py')
+
+DATA_HEADER = 'Fecha,Equipo,CodigoCombustible,LtsIngreso,LtsEgreso,HsKm,Comentarios,CostoUnitarioLt'
+
+# SETUP lines as spreadsheets export them: quoted, padded around the quotes, and with commas inside quoted values
+SETUP_LINES = [
+    '"SETUP","Saldo Inicial GASOIL","1,250.5"',
+    'SETUP, Saldo Inicial NAFTA ,"300" ',
+    '"SETUP","MAPEO CODIGO","001","GASOIL"',
+    'SETUP,MAPEO CODIGO,"002" ,NAFTA',
+    'SETUP,MAPEO CODIGO, "003" , "GASOIL, ALTA" ',
+    'SETUP,mapeo codigo,"0""4",NAFTA',
+    'SETUP,MAPEO CODIGO,005,GASOIL',
+]
+
+DATA_LINES = [
+    '01-03-2025,MO-13-V,001,0,10,100,,1000',
+    '02-03-2025,MO-13-V,002,0,10,110,,1000',
+    '03-03-2025,MO-14-V,003,0,10,120,,1000',
+    '04-03-2025,MO-14-V,"0""4",0,10,130,,1000',
+    '05-03-2025,MO-15-V,005,0,10,140,,1000',
+]
+
+
+@pytest.fixture(scope='module')
+def app():
+    # Runs the Streamlit script in bare mode; only its functions are used
+    return runpy.run_path(APP_PATH, run_name='visma_app')
+
+
+def expected_setup(app):
+    """Lo que produce csv.reader sobre las mismas líneas SETUP, con los campos sin espacios."""
+    saldos = {'GASOIL': 0.0, 'NAFTA': 0.0}
+    mapping = {}
+    # skipinitialspace: a space before an opening quote still starts a quoted field
+    for row in csv.reader(io.StringIO('\n'.join(SETUP_LINES)), skipinitialspace=True):
+        fields = [field.strip() for field in row]
+        setup_type = fields[1].upper()
+        if setup_type == 'SALDO INICIAL GASOIL':
+            saldos['GASOIL'] = app['safe_float_parse'](fields[2])
+        elif setup_type == 'SALDO INICIAL NAFTA':
+            saldos['NAFTA'] = app['safe_float_parse'](fields[2])
+        elif setup_type == 'MAPEO CODIGO':
+            mapping[fields[2]] = fields[3]
+    return saldos, mapping
+
+
+def test_setup_lines_match_csv_reader(app):
+    raw_bytes = '\n'.join(SETUP_LINES + [DATA_HEADER] + DATA_LINES).encode('utf-8')
+    fuel_df, initial_stock = app['parse_fuel_log_bytes'](raw_bytes)
+    saldos, mapping = expected_setup(app)
+
+    assert initial_stock == saldos
+    assert len(fuel_df) == len(DATA_LINES)
+    parsed_mapping = dict(zip(fuel_df['Codigo'].astype(str), fuel_df['Tipo de Comb.'].astype(str)))
+    assert parsed_mapping == mapping
+
+
+def test_padded_quoted_code_is_mapped(app):
+    raw_bytes = '\n'.join(['SETUP,MAPEO CODIGO,"002" ,GASOIL', DATA_HEADER, DATA_LINES[1]]).encode('utf-8')
+    fuel_df, _ = app['parse_fuel_log_bytes'](raw_bytes)
+
+    assert fuel_df['Tipo de Comb.'].astype(str).tolist() == ['GASOIL']